@@ -0,0 +1,134 @@
+"""Benchmark activation checkpointing of the encoder layers.
+
+For each `--every` value (0 stores all activations, k recomputes every k-th
+layer in backward) one forward and backward pass of a randomly initialized
+`BertForMultipleChoice` is timed, and the memory it takes on top of the
+weights and gradients is measured: `max_memory_allocated` on CUDA, the peak
+resident set size on the CPU. Every configuration runs in its own process,
+so the peaks do not mix. From the memory per example, the table shows the
+largest batch that fits next to the weights, gradients and Adam state of
+the model in `--memory_gb`.
+
+Example:
+    python benchmarks/bench_activation_checkpointing.py --max_seq_length=320 --batch_size=4 \
+        --every 0 4 2 1
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pytorch_pretrained_bert.modeling import BertConfig, BertForMultipleChoice
+from pytorch_pretrained_bert.modeling_utils import set_activation_checkpointing
+
+
+def current_rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(args, every):
+    """Runs the steps of one configuration, returns its activation memory and step time."""
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size_or_config_json_file=30522, hidden_size=args.hidden_size,
+                        num_hidden_layers=args.num_hidden_layers, num_attention_heads=args.num_attention_heads,
+                        intermediate_size=4 * args.hidden_size)
+    model = BertForMultipleChoice(config, num_choices=4).to(device)
+    model.train()
+    set_activation_checkpointing(model, every)
+    for p in model.parameters():
+        p.grad = torch.zeros_like(p)
+
+    input_ids = torch.randint(0, config.vocab_size, (args.batch_size, 4, args.max_seq_length), device=device)
+    segment_ids = torch.zeros_like(input_ids)
+    input_mask = torch.ones_like(input_ids)
+    label_ids = torch.randint(0, 4, (args.batch_size,), device=device)
+
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        baseline = torch.cuda.memory_allocated()
+    else:
+        baseline = current_rss()
+    elapsed = 0.0
+    for step in range(args.warmup_steps + args.steps):
+        start = time.time()
+        loss = model(input_ids, segment_ids, input_mask, label_ids)
+        loss.backward()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        if step >= args.warmup_steps:
+            elapsed += time.time() - start
+    peak = torch.cuda.max_memory_allocated() if device.type == "cuda" else peak_rss()
+    num_params = sum(p.numel() for p in model.parameters())
+    return {'activation_bytes': peak - baseline, 'step_time': elapsed / args.steps, 'num_params': num_params}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hidden_size", type=int, default=1024)
+    parser.add_argument("--num_hidden_layers", type=int, default=24)
+    parser.add_argument("--num_attention_heads", type=int, default=None,
+                        help="Default: one head per 64 hidden units, at least one.")
+    parser.add_argument("--max_seq_length", type=int, default=320)
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--every", type=int, nargs="+", default=[0, 4, 2, 1],
+                        help="Values of --activation_checkpoint_every to compare.")
+    parser.add_argument("--steps", type=int, default=3)
+    parser.add_argument("--warmup_steps", type=int, default=1)
+    parser.add_argument("--memory_gb", type=float, default=None,
+                        help="Memory of the device to size the largest batch for (default: the GPU's).")
+    parser.add_argument("--no_cuda", default=False, action='store_true')
+    parser.add_argument("--child", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.num_attention_heads is None:
+        args.num_attention_heads = max(1, args.hidden_size // 64)
+
+    if args.child is not None:
+        print(json.dumps(measure(args, args.child)))
+        return
+
+    memory_gb = args.memory_gb
+    if memory_gb is None:
+        use_cuda = torch.cuda.is_available() and not args.no_cuda
+        memory_gb = torch.cuda.get_device_properties(0).total_memory / 2 ** 30 if use_cuda else 16.0
+    results = []
+    for every in args.every:
+        child = sys.argv[1:] + ["--child", str(every)]
+        output = subprocess.run([sys.executable, os.path.abspath(__file__)] + child, check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+        results.append((every, json.loads(output.strip().splitlines()[-1])))
+
+    # fp32 weights, gradients and the two Adam moments
+    static_bytes = 16 * results[0][1]['num_params']
+    base_per_example = results[0][1]['activation_bytes'] / args.batch_size
+    base_time = results[0][1]['step_time']
+    print("layers: {}, hidden: {}, max_seq_length: {}, batch: {}, memory: {:.0f} GB".format(
+        args.num_hidden_layers, args.hidden_size, args.max_seq_length, args.batch_size, memory_gb))
+    print("{:>6} {:>12} {:>12} {:>10} {:>10} {:>10} {:>10}".format(
+        "every", "act. MB", "MB/example", "max batch", "batch x", "samples/s", "time x"))
+    for every, result in results:
+        per_example = result['activation_bytes'] / args.batch_size
+        max_batch = int(max(0, memory_gb * 2 ** 30 - static_bytes) // max(1, per_example))
+        print("{:>6} {:>12.0f} {:>12.1f} {:>10} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+            every, result['activation_bytes'] / 2 ** 20, per_example / 2 ** 20, max_batch,
+            base_per_example / max(1, per_example), args.batch_size / result['step_time'],
+            result['step_time'] / base_time))
+
+
+if __name__ == "__main__":
+    main()
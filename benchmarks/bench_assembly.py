@@ -0,0 +1,82 @@
+"""Benchmark the per-choice feature loop against the vectorized NumPy assembly.
+
+Times the list-based reference pipeline (`reference_pipeline.py`), which lays
+out every choice with Python lists, against `encode_examples` followed by
+`assemble_feature_arrays`, which only tokenizes per example and fills one
+(N, 4, L) array. The assembly
+step is also timed on its own from already encoded examples, and the outputs
+are checked to be identical.
+
+Example:
+    python benchmarks/bench_assembly.py --data_dir=./RACE \
+        --vocab_file=./bert-large-uncased-vocab.txt --do_lower_case --max_seq_length=320
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pytorch_pretrained_bert.tokenization import BertTokenizer
+from pytorch_pretrained_bert.race_utils import read_race_examples, group_examples_by_article, encode_examples
+from pytorch_pretrained_bert.race_utils import encode_article_examples, encoded_to_token_arrays, assemble_feature_arrays
+
+from reference_pipeline import convert_examples_to_features, features_to_arrays
+
+
+def timed(fn, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.time()
+        result = fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--vocab_file", type=str, required=True)
+    parser.add_argument("--do_lower_case", default=False, action='store_true')
+    parser.add_argument("--split", type=str, default="dev")
+    parser.add_argument("--max_seq_length", type=int, default=320)
+    parser.add_argument("--max_examples", type=int, default=0,
+                        help="Only convert the first N examples (0 converts all of them).")
+    parser.add_argument("--truncate_article_only", default=False, action='store_true')
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    tokenizer = BertTokenizer.from_pretrained(args.vocab_file, do_lower_case=args.do_lower_case)
+    split_dir = os.path.join(args.data_dir, args.split)
+    examples = read_race_examples([split_dir + '/high', split_dir + '/middle'])
+    if args.max_examples > 0:
+        examples = examples[:args.max_examples]
+    print("examples: {}, max_seq_length: {}".format(len(examples), args.max_seq_length))
+
+    loop_time, reference = timed(lambda: features_to_arrays(convert_examples_to_features(
+        examples, tokenizer, args.max_seq_length, truncate_article_only=args.truncate_article_only)), args.repeat)
+    cls_id, sep_id = tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+    vectorized_time, arrays = timed(lambda: assemble_feature_arrays(
+        encode_examples(examples, tokenizer, args.max_seq_length), args.max_seq_length, cls_id, sep_id,
+        args.truncate_article_only), args.repeat)
+
+    token_arrays = encoded_to_token_arrays([encode_article_examples(group, tokenizer, args.max_seq_length)
+                                            for group in group_examples_by_article(examples)])
+    assembly_time, _ = timed(lambda: assemble_feature_arrays(
+        token_arrays, args.max_seq_length, cls_id, sep_id, args.truncate_article_only), args.repeat)
+
+    same = all(np.array_equal(reference[field], arrays[field]) for field in reference)
+    print("{:>12} {:>10} {:>12}".format("mode", "seconds", "examples/s"))
+    for mode, elapsed in (("loop", loop_time), ("vectorized", vectorized_time), ("assembly", assembly_time)):
+        print("{:>12} {:>10.3f} {:>12.1f}".format(mode, elapsed, len(examples) / elapsed))
+    print("end-to-end speedup: {:.2f}x, identical: {}".format(loop_time / vectorized_time, same))
+
+
+if __name__ == "__main__":
+    main()
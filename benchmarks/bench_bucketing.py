@@ -0,0 +1,103 @@
+"""Benchmark fixed padding against length bucketing with per-batch trimming.
+
+Runs forward and backward passes of BertForMultipleChoice over the same
+examples, once with every batch padded to max_seq_length and once with
+LengthBucketBatchSampler + trim_padding_collate, and reports the padding
+ratio and the measured speedup.
+
+Example:
+    python benchmarks/bench_bucketing.py --data_dir=./RACE \
+        --vocab_file=./bert-large-uncased-vocab.txt --do_lower_case \
+        --bert_config_file=./bert_config.json --max_seq_length=320 --batch_size=4
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+from torch.utils.data import DataLoader, RandomSampler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pytorch_pretrained_bert.tokenization import BertTokenizer
+from pytorch_pretrained_bert.modeling import BertConfig, BertForMultipleChoice
+from pytorch_pretrained_bert.race_utils import list_race_files, load_or_convert_features
+from pytorch_pretrained_bert.race_utils import batch_to_inputs, example_lengths, LengthBucketBatchSampler
+from pytorch_pretrained_bert.race_utils import trim_padding_collate, padding_stats
+
+from reference_pipeline import feature_arrays_to_dataset
+
+
+def run(model, dataloader, device, num_batches):
+    batches = 0
+    start = None
+    for batch in dataloader:
+        input_ids, input_mask, segment_ids, label_ids, _, _, _ = batch_to_inputs(batch, device)
+        loss = model(input_ids, segment_ids, input_mask, label_ids)
+        loss.backward()
+        model.zero_grad()
+        batches += 1
+        if batches == 1:
+            # the first batch warms up the allocator and kernels
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.time()
+        if batches > num_batches:
+            break
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return time.time() - start, batches - 1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--vocab_file", type=str, required=True)
+    parser.add_argument("--do_lower_case", default=False, action='store_true')
+    parser.add_argument("--bert_config_file", type=str, default=None,
+                        help="Model config; a 4-layer BERT-base sized model is used if not given.")
+    parser.add_argument("--split", type=str, default="dev")
+    parser.add_argument("--max_seq_length", type=int, default=320)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--num_batches", type=int, default=50)
+    parser.add_argument("--feature_cache_dir", type=str, default="feature_cache")
+    parser.add_argument("--no_cuda", default=False, action='store_true')
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    tokenizer = BertTokenizer.from_pretrained(args.vocab_file, do_lower_case=args.do_lower_case)
+    split_dir = os.path.join(args.data_dir, args.split)
+    arrays, _ = load_or_convert_features(list_race_files([split_dir + '/high', split_dir + '/middle']),
+                                         tokenizer, args.max_seq_length, args.feature_cache_dir, name=args.split)
+    data = feature_arrays_to_dataset(arrays)
+
+    if args.bert_config_file:
+        config = BertConfig(args.bert_config_file)
+    else:
+        config = BertConfig(len(tokenizer.vocab), num_hidden_layers=4)
+    model = BertForMultipleChoice(config, num_choices=4).to(device)
+    model.train()
+
+    torch.manual_seed(0)
+    fixed = DataLoader(data, sampler=RandomSampler(data), batch_size=args.batch_size)
+    torch.manual_seed(0)
+    batch_sampler = LengthBucketBatchSampler(RandomSampler(data), example_lengths(arrays), args.batch_size)
+    bucketed = DataLoader(data, batch_sampler=batch_sampler, collate_fn=trim_padding_collate)
+
+    stats = padding_stats(arrays, batch_sampler.batches(), args.max_seq_length)
+    fixed_time, fixed_batches = run(model, fixed, device, args.num_batches)
+    bucketed_time, bucketed_batches = run(model, bucketed, device, args.num_batches)
+
+    print("examples: {}, device: {}".format(len(data), device))
+    print("{:>10} {:>10} {:>12}".format("mode", "padding", "batches/s"))
+    print("{:>10} {:>9.1f}% {:>12.2f}".format("fixed", 100 * stats['padding_fixed'], fixed_batches / fixed_time))
+    print("{:>10} {:>9.1f}% {:>12.2f}".format("bucketed", 100 * stats['padding_bucketed'],
+                                              bucketed_batches / bucketed_time))
+    print("token ratio: {:.2f}x, measured speedup: {:.2f}x".format(
+        stats['speedup'], (bucketed_batches / bucketed_time) / (fixed_batches / fixed_time)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Benchmark data-parallel training on CPU processes over gloo.
+
+Trains a small, randomly initialized `BertForMultipleChoice` on random
+inputs with `DistributedDataParallel`, as the runners do with `--no_cuda`,
+and reports the samples/s of all processes together. Start it through
+launch.py to compare process counts and core bindings; started directly it
+runs a single process without DistributedDataParallel.
+
+Example:
+    python launch.py --nproc_per_node=4 --core_id=0 --cores_per_proc=4 \
+        benchmarks/bench_cpu_ddp.py --max_seq_length=128 --batch_size=4
+    python benchmarks/bench_cpu_ddp.py --max_seq_length=128 --batch_size=16
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+from torch.nn.parallel.distributed import DistributedDataParallel
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pytorch_pretrained_bert.modeling import BertConfig, BertForMultipleChoice
+from pytorch_pretrained_bert.utils import init_distributed, tune_cpu_threads, get_world_size, is_main_process
+from pytorch_pretrained_bert.utils import barrier
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--local_rank", type=int, default=-1)
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--num_hidden_layers", type=int, default=4)
+    parser.add_argument("--num_attention_heads", type=int, default=None,
+                        help="Default: one head per 64 hidden units, at least one.")
+    parser.add_argument("--max_seq_length", type=int, default=128)
+    parser.add_argument("--batch_size", type=int, default=8, help="Examples per process and step.")
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--warmup_steps", type=int, default=3)
+    parser.add_argument("--bf16", default=False, action='store_true')
+    parser.add_argument("--cpu_threads", type=int, default=0)
+    args = parser.parse_args()
+    if args.num_attention_heads is None:
+        args.num_attention_heads = max(1, args.hidden_size // 64)
+
+    device, _ = init_distributed(args.local_rank, no_cuda=True)
+    num_threads, _ = tune_cpu_threads(args.cpu_threads)
+    torch.manual_seed(0)
+
+    config = BertConfig(vocab_size_or_config_json_file=30522, hidden_size=args.hidden_size,
+                        num_hidden_layers=args.num_hidden_layers, num_attention_heads=args.num_attention_heads,
+                        intermediate_size=4 * args.hidden_size)
+    model = BertForMultipleChoice(config, num_choices=4)
+    if args.local_rank != -1:
+        model = DistributedDataParallel(model)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+
+    input_ids = torch.randint(0, config.vocab_size, (args.batch_size, 4, args.max_seq_length))
+    segment_ids = torch.zeros_like(input_ids)
+    input_mask = torch.ones_like(input_ids)
+    label_ids = torch.randint(0, 4, (args.batch_size,))
+
+    for step in range(args.warmup_steps + args.steps):
+        if step == args.warmup_steps:
+            barrier()
+            start = time.time()
+        with torch.autocast('cpu', dtype=torch.bfloat16, enabled=args.bf16):
+            loss = model(input_ids, segment_ids, input_mask, label_ids)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+    barrier()
+    elapsed = time.time() - start
+
+    if is_main_process():
+        world_size = get_world_size()
+        print("{:>10} {:>8} {:>5} {:>10} {:>10}".format("processes", "threads", "bf16", "ms/step", "samples/s"))
+        print("{:>10} {:>8} {:>5} {:>10.1f} {:>10.1f}".format(
+            world_size, num_threads, str(args.bf16), 1000 * elapsed / args.steps,
+            args.steps * args.batch_size * world_size / elapsed))
+
+
+if __name__ == "__main__":
+    main()
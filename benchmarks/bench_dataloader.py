@@ -0,0 +1,85 @@
+"""Benchmark the data-wait time per training step.
+
+Runs the training data pipeline with and without DataLoader workers and the
+background prefetcher, and reports how long the training loop waited for
+each batch. The training step itself is simulated with `--step_ms` of sleep,
+which, like a GPU step, releases the GIL.
+
+Example:
+    python benchmarks/bench_dataloader.py --data_dir=./RACE \
+        --vocab_file=./bert-large-uncased-vocab.txt --do_lower_case --max_seq_length=320 \
+        --batch_size=32 --num_workers=4 --streaming
+"""
+
+import os
+import sys
+import time
+import argparse
+
+from torch.utils.data import DataLoader, RandomSampler, BatchSampler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pytorch_pretrained_bert.tokenization import BertTokenizer
+from pytorch_pretrained_bert.race_utils import list_race_files, load_or_convert_features, FeatureBatchDataset
+from pytorch_pretrained_bert.race_utils import RaceStreamingDataset, pack_choices, pack_choices_collate
+from pytorch_pretrained_bert.race_utils import BackgroundPrefetcher, set_worker_affinity
+
+
+def make_loader(args, tokenizer, files, arrays, num_workers):
+    if args.streaming:
+        data = RaceStreamingDataset(files, tokenizer, args.max_seq_length, len(arrays['label']))
+        return DataLoader(data, batch_size=args.batch_size, collate_fn=pack_choices_collate,
+                          num_workers=num_workers, worker_init_fn=set_worker_affinity, pin_memory=True)
+    data = FeatureBatchDataset(arrays, transform=pack_choices)
+    return DataLoader(data, sampler=BatchSampler(RandomSampler(data), args.batch_size, drop_last=False),
+                      batch_size=None, num_workers=num_workers, persistent_workers=num_workers > 0,
+                      worker_init_fn=set_worker_affinity, pin_memory=True)
+
+
+def run(loader, depth, step_ms, epochs):
+    batches = BackgroundPrefetcher(loader, depth=depth)
+    start = time.time()
+    for _ in range(epochs):
+        for _ in batches:
+            time.sleep(step_ms / 1000)
+    return 1000 * batches.wait_time / batches.steps, 1000 * (time.time() - start) / batches.steps
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--vocab_file", type=str, required=True)
+    parser.add_argument("--do_lower_case", default=False, action='store_true')
+    parser.add_argument("--split", type=str, default="dev")
+    parser.add_argument("--max_seq_length", type=int, default=320)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--num_workers", type=int, default=2)
+    parser.add_argument("--prefetch_batches", type=int, default=2)
+    parser.add_argument("--step_ms", type=float, default=20.0,
+                        help="Simulated duration of one training step.")
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--streaming", default=False, action='store_true',
+                        help="Tokenize in the loader (RaceStreamingDataset) instead of reading the feature cache.")
+    parser.add_argument("--feature_cache_dir", type=str, default="feature_cache")
+    args = parser.parse_args()
+
+    tokenizer = BertTokenizer.from_pretrained(args.vocab_file, do_lower_case=args.do_lower_case)
+    split_dir = os.path.join(args.data_dir, args.split)
+    files = list_race_files([split_dir + '/high', split_dir + '/middle'])
+    arrays, _ = load_or_convert_features(files, tokenizer, args.max_seq_length, args.feature_cache_dir,
+                                         name=args.split)
+
+    print("examples: {}, cpus: {}, step: {} ms".format(
+        len(arrays['label']), len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count(),
+        args.step_ms))
+    print("{:>8} {:>9} {:>14} {:>14}".format("workers", "prefetch", "wait ms/step", "total ms/step"))
+    for num_workers, depth in ((0, 0), (0, args.prefetch_batches), (args.num_workers, 0),
+                               (args.num_workers, args.prefetch_batches)):
+        loader = make_loader(args, tokenizer, files, arrays, num_workers)
+        wait, total = run(loader, depth, args.step_ms, args.epochs)
+        print("{:>8} {:>9} {:>14.2f} {:>14.2f}".format(num_workers, depth, wait, total))
+
+
+if __name__ == "__main__":
+    main()
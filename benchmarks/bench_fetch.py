@@ -0,0 +1,78 @@
+"""Benchmark the cost of fetching a training batch.
+
+Compares a DataLoader over a `TensorDataset` (one `__getitem__` per sample,
+stacked by `default_collate`) with `FeatureBatchDataset`, which gathers
+every field of a batch with a single `index_select`. Both run on the
+training thread (`num_workers=0`) over the same shuffled batches, without a
+model, and the batches are checked to be identical.
+
+Example:
+    python benchmarks/bench_fetch.py --data_dir=./RACE \
+        --vocab_file=./bert-large-uncased-vocab.txt --do_lower_case --max_seq_length=320 --batch_size=32
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+from torch.utils.data import DataLoader, RandomSampler, BatchSampler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pytorch_pretrained_bert.tokenization import BertTokenizer
+from pytorch_pretrained_bert.race_utils import list_race_files, load_or_convert_features
+from pytorch_pretrained_bert.race_utils import FeatureBatchDataset, trim_padding, trim_padding_collate
+
+from reference_pipeline import feature_arrays_to_dataset
+
+
+def fetch(dataloader, epochs):
+    batches = 0
+    start = time.time()
+    for _ in range(epochs):
+        for _ in dataloader:
+            batches += 1
+    return (time.time() - start) / batches
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--vocab_file", type=str, required=True)
+    parser.add_argument("--do_lower_case", default=False, action='store_true')
+    parser.add_argument("--split", type=str, default="dev")
+    parser.add_argument("--max_seq_length", type=int, default=320)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--trim_padding", default=False, action='store_true',
+                        help="Also cut every batch to its longest sequence, as --length_bucketing does.")
+    parser.add_argument("--feature_cache_dir", type=str, default="feature_cache")
+    args = parser.parse_args()
+
+    tokenizer = BertTokenizer.from_pretrained(args.vocab_file, do_lower_case=args.do_lower_case)
+    split_dir = os.path.join(args.data_dir, args.split)
+    arrays, _ = load_or_convert_features(list_race_files([split_dir + '/high', split_dir + '/middle']),
+                                         tokenizer, args.max_seq_length, args.feature_cache_dir, name=args.split)
+
+    per_sample_data = feature_arrays_to_dataset(arrays)
+    batch_data = FeatureBatchDataset(arrays, transform=trim_padding if args.trim_padding else None)
+    batches = list(BatchSampler(RandomSampler(per_sample_data), args.batch_size, drop_last=False))
+    per_sample = DataLoader(per_sample_data, batch_sampler=batches,
+                            collate_fn=trim_padding_collate if args.trim_padding else None)
+    batched = DataLoader(batch_data, sampler=batches, batch_size=None)
+
+    same = all(all(torch.equal(a, b) for a, b in zip(x, y)) for x, y in zip(per_sample, batched))
+    per_sample_time = fetch(per_sample, args.epochs)
+    batched_time = fetch(batched, args.epochs)
+
+    print("examples: {}, batch size: {}, identical: {}".format(len(batch_data), args.batch_size, same))
+    print("{:>12} {:>12}".format("fetch", "ms/step"))
+    print("{:>12} {:>12.3f}".format("per-sample", 1000 * per_sample_time))
+    print("{:>12} {:>12.3f}".format("batched", 1000 * batched_time))
+    print("speedup: {:.2f}x".format(per_sample_time / batched_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Benchmark how long the package and the entry points take to import.
+
+Every target is imported `--repeat` times in a fresh interpreter under
+`python -X importtime`, loading the runners from their files since names
+like `run_race.new.py` cannot be imported by name. The table shows the
+fastest run: the time spent importing modules (the self times of
+`-X importtime`, without what the interpreter imports at startup), the
+share of it spent in torch, which of the heavy optional dependencies it
+tried to import (found or not), and the slowest other top-level packages.
+`--help_time` also times `python <entry point> --help` end to end,
+interpreter start included.
+
+Example:
+    python benchmarks/bench_import_time.py
+    python benchmarks/bench_import_time.py --targets run_race.py test_race.py --repeat=5 --help_time
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+import collections
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TARGETS = ["pytorch_pretrained_bert", "run_race.py", "run_race.new.py", "run_race.single.py",
+           "run_race.albert.py", "test_race.py", "launch.py", "pack_race.py"]
+OPTIONAL = ["transformers", "tensorboardX", "apex", "boto3", "requests", "sentencepiece"]
+
+LOAD_FILE = ("import sys, importlib.util\n"
+             "spec = importlib.util.spec_from_file_location('_bench_target', sys.argv[1])\n"
+             "spec.loader.exec_module(importlib.util.module_from_spec(spec))\n")
+
+
+def parse_importtime(stderr):
+    """Returns the self time in microseconds of every module imported, by module name."""
+    self_us = collections.OrderedDict()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        self_us[fields[2].strip()] = int(fields[0])
+    return self_us
+
+
+def run_importtime(code, *argv):
+    command = [sys.executable, "-X", "importtime", "-c", code] + list(argv)
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    result = subprocess.run(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return parse_importtime(result.stderr)
+
+
+def measure(target, startup):
+    """Returns the import time of `target` by top-level package, without what the interpreter imports at startup."""
+    if target.endswith(".py"):
+        self_us = run_importtime(LOAD_FILE, os.path.join(ROOT, target))
+    else:
+        self_us = run_importtime("import {}".format(target))
+    by_package = collections.Counter()
+    for module, us in self_us.items():
+        if module not in startup:
+            by_package[module.split(".")[0]] += us
+    return by_package
+
+
+def time_help(target):
+    start = time.time()
+    subprocess.run([sys.executable, os.path.join(ROOT, target), "--help"], cwd=ROOT, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--targets", nargs="+", default=TARGETS,
+                        help="Packages/modules to import or entry point files relative to the repository.")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top", type=int, default=3, help="Slowest packages besides torch to list per target.")
+    parser.add_argument("--help_time", "--help-time", dest="help_time", default=False, action='store_true',
+                        help="Also time `python <entry point> --help`.")
+    args = parser.parse_args()
+
+    startup = set(run_importtime("pass"))
+    print("{:<24} {:>10} {:>10} {:>10}  {:<28} {}".format(
+        "target", "import ms", "torch ms", "--help ms", "optional deps", "slowest other packages (ms)"))
+    for target in args.targets:
+        try:
+            by_package = min((measure(target, startup) for _ in range(args.repeat)), key=lambda c: sum(c.values()))
+        except RuntimeError as e:
+            print("{:<24} import failed: {}".format(target, e))
+            continue
+        optional = [name for name in OPTIONAL if name in by_package]
+        others = [(name, us) for name, us in by_package.most_common() if name != "torch"][:args.top]
+        help_ms = ""
+        if args.help_time and target.endswith(".py"):
+            help_ms = "{:.0f}".format(1000 * min(time_help(target) for _ in range(args.repeat)))
+        print("{:<24} {:>10.0f} {:>10.0f} {:>10}  {:<28} {}".format(
+            target, sum(by_package.values()) / 1000, by_package["torch"] / 1000, help_ms,
+            ",".join(optional) or "-", ", ".join("{} {:.0f}".format(name, us / 1000) for name, us in others)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Benchmark RACE feature conversion against the number of worker processes.
+
+Times `encode_examples`, the tokenization step that preprocessing spreads
+over a process pool, and checks that every worker count gives the same
+token arrays.
+
+Example:
+    python benchmarks/bench_preprocess.py --data_dir=./RACE \
+        --vocab_file=./bert-large-uncased-vocab.txt --do_lower_case \
+        --max_seq_length=320 --workers 1 2 4 8 16
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pytorch_pretrained_bert.tokenization import BertTokenizer
+from pytorch_pretrained_bert.race_utils import read_race_examples, encode_examples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--vocab_file", type=str, required=True)
+    parser.add_argument("--do_lower_case", default=False, action='store_true')
+    parser.add_argument("--split", type=str, default="train")
+    parser.add_argument("--max_seq_length", type=int, default=320)
+    parser.add_argument("--max_examples", type=int, default=0,
+                        help="Only convert the first N examples (0 converts all of them).")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    tokenizer = BertTokenizer.from_pretrained(args.vocab_file, do_lower_case=args.do_lower_case)
+    split_dir = os.path.join(args.data_dir, args.split)
+    examples = read_race_examples([split_dir + '/high', split_dir + '/middle'])
+    if args.max_examples > 0:
+        examples = examples[:args.max_examples]
+    print("examples: {}, cpus: {}".format(len(examples), os.cpu_count()))
+
+    reference = None
+    baseline = None
+    print("{:>8} {:>10} {:>12} {:>8} {:>6}".format("workers", "seconds", "examples/s", "speedup", "same"))
+    for num_workers in args.workers:
+        start = time.time()
+        token_arrays = encode_examples(examples, tokenizer, args.max_seq_length, num_workers=num_workers)
+        elapsed = time.time() - start
+        if baseline is None:
+            baseline = elapsed
+        if reference is None:
+            reference = token_arrays
+        same = all(np.array_equal(reference[field], token_arrays[field]) for field in reference)
+        print("{:>8} {:>10.2f} {:>12.1f} {:>8.2f} {:>6}".format(
+            num_workers, elapsed, len(examples) / elapsed, baseline / elapsed, str(same)))
+
+
+if __name__ == "__main__":
+    main()
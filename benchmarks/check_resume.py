@@ -0,0 +1,89 @@
+"""Check that `--resume` continues with the same batches as an uninterrupted run.
+
+Builds the training batches the way the runners do (a seeded
+`RandomSampler`, optionally length bucketing, `ResumableBatchSampler` and a
+DataLoader with persistent workers and a generator of its own) over a small
+index dataset. The batches of an uninterrupted run of `--epochs` epochs are
+compared with those of runs resumed at several points, each in a fresh
+DataLoader as after a restart. Exits with status 1 on any difference.
+
+Example:
+    python benchmarks/check_resume.py --num_workers 0 2
+    python benchmarks/check_resume.py --num_workers 2 --length_bucketing
+"""
+
+import os
+import sys
+import argparse
+
+import torch
+from torch.utils.data import Dataset, DataLoader, RandomSampler, BatchSampler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pytorch_pretrained_bert.race_utils import ResumableBatchSampler, LengthBucketBatchSampler, set_worker_affinity
+
+
+class IndexDataset(Dataset):
+    def __init__(self, size):
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, indices):
+        return torch.tensor(indices)
+
+
+def run(args, num_workers, start_epoch=0, start_batch=0):
+    """Returns `(epoch, step, indices)` of every batch from `start_epoch`/`start_batch` on."""
+    data = IndexDataset(args.num_examples)
+    train_generator = torch.Generator()
+    train_generator.manual_seed(args.seed)
+    worker_generator = torch.Generator()
+    worker_generator.manual_seed(args.seed)
+    sampler = RandomSampler(data, generator=train_generator)
+    if args.length_bucketing:
+        lengths = torch.randint(16, 512, (args.num_examples,), generator=torch.Generator().manual_seed(0)).numpy()
+        batch_sampler = LengthBucketBatchSampler(sampler, lengths, args.batch_size, seed=args.seed)
+    else:
+        batch_sampler = BatchSampler(sampler, args.batch_size, drop_last=False)
+    batch_sampler = ResumableBatchSampler(batch_sampler, seed=args.seed)
+    loader = DataLoader(data, sampler=batch_sampler, batch_size=None, num_workers=num_workers,
+                        persistent_workers=num_workers > 0, worker_init_fn=set_worker_affinity,
+                        generator=worker_generator)
+    batches = []
+    for ep in range(start_epoch, args.epochs):
+        first_batch = start_batch if ep == start_epoch else 0
+        batch_sampler.set_epoch(ep, first_batch)
+        for step, batch in enumerate(loader, first_batch):
+            batches.append((ep, step, batch.tolist()))
+    return batches
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_workers", type=int, nargs="+", default=[0, 2])
+    parser.add_argument("--num_examples", type=int, default=200)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--length_bucketing", default=False, action='store_true')
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    failed = False
+    for num_workers in args.num_workers:
+        full = run(args, num_workers)
+        steps_per_epoch = len(full) // args.epochs
+        for start_epoch in range(args.epochs):
+            for start_batch in (0, steps_per_epoch // 2):
+                resumed = run(args, num_workers, start_epoch, start_batch)
+                same = full[len(full) - len(resumed):] == resumed
+                failed |= not same
+                print("num_workers {}, resumed at epoch {} batch {:>3}: {}".format(
+                    num_workers, start_epoch, start_batch, "same batches" if same else "DIFFERENT batches"))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""Reference implementation of the list-based RACE feature pipeline.
+
+The library builds features column-wise (`encode_examples` followed by
+`assemble_feature_arrays`); this module keeps the per-choice conversion into
+`InputFeatures` it replaced, and a per-sample `TensorDataset` over the
+arrays, so the benchmarks can time the columnar pipeline against them and
+check that both give identical features. Nothing outside `benchmarks/`
+should use it.
+"""
+
+import os
+import sys
+import collections
+import multiprocessing
+
+import numpy as np
+import torch
+from torch.utils.data import TensorDataset
+from tqdm import tqdm
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pytorch_pretrained_bert.utils import is_main_process
+from pytorch_pretrained_bert.race_utils import FEATURE_FIELDS, tokenize_article, group_examples_by_article
+
+
+class InputFeatures(object):
+    def __init__(self,
+                 example_id,
+                 choices_features,
+                 label
+
+                 ):
+        self.example_id = example_id
+        self.choices_features = [
+            {
+                'input_ids': input_ids,
+                'input_mask': input_mask,
+                'segment_ids': segment_ids,
+                'doc_len': doc_len,
+                'ques_len': ques_len,
+                'option_len': option_len
+            }
+            for _, input_ids, input_mask, segment_ids, doc_len, ques_len, option_len in choices_features
+        ]
+        self.label = label
+
+
+def convert_example_to_features(example, tokenizer, max_seq_length, truncate_article_only=False,
+                                context_tokens=None):
+    """Converts a single `RaceExample` into `InputFeatures`.
+
+    `context_tokens` may hold the already tokenized article, in which case it
+    is only read (every choice works on its own copy).
+    """
+    if context_tokens is None:
+        context_tokens = tokenize_article(tokenizer, example.context_sentence, max_seq_length)
+    start_ending_tokens = tokenizer.tokenize(example.start_ending)
+
+    choices_features = []
+    for ending_index, ending in enumerate(example.endings):
+        # We create a copy of the context tokens in order to be
+        # able to shrink it according to ending_tokens
+        context_tokens_choice = context_tokens[:]  # + start_ending_tokens
+
+        ending_token = tokenizer.tokenize(ending)
+        option_len = len(ending_token)
+        ques_len = len(start_ending_tokens)
+
+        ending_tokens = start_ending_tokens + ending_token
+
+        # Modifies `context_tokens_choice` and `ending_tokens` in
+        # place so that the total length is less than the
+        # specified length.  Account for [CLS], [SEP], [SEP] with
+        # "- 3"
+        if truncate_article_only:
+            _truncate_seq_a(context_tokens_choice, ending_tokens, max_seq_length - 3)
+        else:
+            _truncate_seq_pair(context_tokens_choice, ending_tokens, max_seq_length - 3)
+        doc_len = len(context_tokens_choice)
+        if len(ending_tokens) + len(context_tokens_choice) >= max_seq_length - 3:
+            ques_len = len(ending_tokens) - option_len
+
+        tokens = ["[CLS]"] + context_tokens_choice + ["[SEP]"] + ending_tokens + ["[SEP]"]
+        segment_ids = [0] * (len(context_tokens_choice) + 2) + [1] * (len(ending_tokens) + 1)
+
+        input_ids = tokenizer.convert_tokens_to_ids(tokens)
+        input_mask = [1] * len(input_ids)
+
+        # Zero-pad up to the sequence length.
+        padding = [0] * (max_seq_length - len(input_ids))
+        input_ids += padding
+        input_mask += padding
+        segment_ids += padding
+
+        assert len(input_ids) == max_seq_length
+        assert len(input_mask) == max_seq_length
+        assert len(segment_ids) == max_seq_length
+
+        choices_features.append((tokens, input_ids, input_mask, segment_ids, doc_len, ques_len, option_len))
+
+    return InputFeatures(
+        example_id=example.race_id,
+        choices_features=choices_features,
+        label=example.label
+    )
+
+
+def convert_article_examples_to_features(examples, tokenizer, max_seq_length, truncate_article_only=False):
+    """Converts the questions of one article, tokenizing the article only once."""
+    context_tokens = tokenize_article(tokenizer, examples[0].context_sentence, max_seq_length)
+    return [convert_example_to_features(example, tokenizer, max_seq_length, truncate_article_only, context_tokens)
+            for example in examples]
+
+
+# State installed once per pool worker so the tokenizer is not pickled per task.
+_worker_state = {}
+
+
+def _init_convert_worker(tokenizer, max_seq_length, truncate_article_only):
+    _worker_state['tokenizer'] = tokenizer
+    _worker_state['max_seq_length'] = max_seq_length
+    _worker_state['truncate_article_only'] = truncate_article_only
+
+
+def _convert_article_in_worker(examples):
+    return convert_article_examples_to_features(examples,
+                                                _worker_state['tokenizer'],
+                                                _worker_state['max_seq_length'],
+                                                _worker_state['truncate_article_only'])
+
+
+def convert_examples_to_features(examples, tokenizer, max_seq_length, num_workers=1, chunksize=16,
+                                 truncate_article_only=False):
+    """Loads a data file into a list of `InputBatch`s.
+
+    Questions are converted article by article so that each passage is
+    tokenized once. With `num_workers` > 1 the articles are spread over a
+    process pool (`chunksize` articles per task); the returned features keep
+    the order of `examples`, exactly as in the serial path.
+    """
+
+    # RACE is a multiple choice task. To perform this task using Bert,
+    # we will use the formatting proposed in "Improving Language
+    # Understanding by Generative Pre-Training" and suggested by
+    # @jacobdevlin-google in this issue
+    # https://github.com/google-research/bert/issues/38.
+    #
+    # The input will be like:
+    # [CLS] Article [SEP] Question + Option [SEP]
+    # for each option
+    #
+    # The model will output a single value for each input. To get the
+    # final decision of the model, we will run a softmax over these 4
+    # outputs.
+    groups = group_examples_by_article(examples)
+    progress = tqdm(total=len(examples), desc="Preprocessing: ") if is_main_process() else None
+    features = []
+    if num_workers > 1 and len(groups) > 1:
+        with multiprocessing.Pool(num_workers,
+                                  initializer=_init_convert_worker,
+                                  initargs=(tokenizer, max_seq_length, truncate_article_only)) as pool:
+            for group_features in pool.imap(_convert_article_in_worker, groups, chunksize=chunksize):
+                features.extend(group_features)
+                if progress is not None:
+                    progress.update(len(group_features))
+    else:
+        for group in groups:
+            features.extend(convert_article_examples_to_features(group, tokenizer, max_seq_length,
+                                                                 truncate_article_only))
+            if progress is not None:
+                progress.update(len(group))
+    if progress is not None:
+        progress.close()
+    return features
+
+
+def select_field(features, field):
+    return [
+        [
+            choice[field]
+            for choice in feature.choices_features
+        ]
+        for feature in features
+    ]
+
+
+def features_to_arrays(features):
+    """Packs a list of `InputFeatures` into contiguous, narrow NumPy arrays.
+
+    Token ids are stored as int16 when the vocabulary allows it (BERT and
+    ALBERT both do), lengths and labels as int16. The masks are reduced to
+    `seq_len`, the number of real tokens of every choice.
+    """
+    input_ids = np.array(select_field(features, 'input_ids'), dtype=np.int32)
+    if input_ids.size == 0 or input_ids.max() < np.iinfo(np.int16).max:
+        input_ids = input_ids.astype(np.int16)
+    arrays = collections.OrderedDict()
+    arrays['input_ids'] = input_ids
+    arrays['label'] = np.array([f.label for f in features], dtype=np.int16)
+    for field in ('doc_len', 'ques_len', 'option_len'):
+        arrays[field] = np.array(select_field(features, field), dtype=np.int16)
+    arrays['seq_len'] = np.array(select_field(features, 'input_mask'), dtype=np.int16).reshape(
+        input_ids.shape).sum(axis=-1, dtype=np.int16)
+    return arrays
+
+
+def feature_arrays_to_dataset(arrays):
+    """Wraps feature arrays into a `TensorDataset` without copying them.
+
+    Tensors keep their narrow storage dtype; callers widen each batch with
+    `.long()` once it is on the device.
+    """
+    return TensorDataset(*[torch.from_numpy(arrays[name]) for name in FEATURE_FIELDS])
+
+
+def _truncated_pair_lengths(len_a, len_b, max_length):
+    """Lengths left by `_truncate_seq_pair`, in closed form."""
+    if len_a + len_b <= max_length:
+        return len_a, len_b
+    # The longer sequence loses tokens until both are even (ties pop from b),
+    # then they shrink in turns, so a short side is kept whole and two long
+    # sides end up with half of the budget each.
+    half = max_length // 2
+    if len_a > len_b and len_b <= half:
+        return max_length - len_b, len_b
+    if len_a <= len_b and len_a <= half:
+        return len_a, max_length - len_a
+    return max_length - half, half
+
+
+def _truncate_seq_pair(tokens_a, tokens_b, max_length):
+    """Truncates a sequence pair in place to the maximum length."""
+
+    # This is a simple heuristic which will always truncate the longer sequence
+    # one token at a time. This makes more sense than truncating an equal percent
+    # of tokens from each, since if one sequence is very short then each token
+    # that's truncated likely contains more information than a longer sequence.
+    len_a, len_b = _truncated_pair_lengths(len(tokens_a), len(tokens_b), max_length)
+    del tokens_a[len_a:]
+    del tokens_b[len_b:]
+
+
+def _truncate_seq_a(tokens_a, tokens_b, max_length):
+    """Truncates only the first sequence (the article) in place to the maximum length."""
+    if len(tokens_b) > max_length:
+        raise IndexError("the second sequence alone is longer than {} tokens".format(max_length))
+    del tokens_a[max_length - len(tokens_b):]
@@ -140,6 +140,9 @@ will not pass ``--local_rank`` when you specify this flag.
 import sys
 import subprocess
 import os
+import shutil
+import hashlib
+import tempfile
 from argparse import ArgumentParser, REMAINDER
 
 
@@ -163,7 +166,9 @@ def parse_args():
                         help="The number of processes to launch on each node, "
                              "for GPU training, this is recommended to be set "
                              "to the number of GPUs in your system so that "
-                             "each process can be bound to a single GPU.")
+                             "each process can be bound to a single GPU. "
+                             "With --no_cuda the processes train on the CPU "
+                             "and communicate over gloo.")
     parser.add_argument("--master_addr", default="127.0.0.1", type=str,
                         help="Master node (rank 0)'s address, should be either "
                              "the IP address or the hostname of node 0, for "
@@ -185,7 +190,21 @@ def parse_args():
     parser.add_argument("--no_python", default=False, action="store_true",
                         help="Do not prepend the training script with \"python\" - just exec "
                              "it directly. Useful when the script is not a Python script.")
-    parser.add_argument("--core_id", type=int, help="CPU CORE ID")
+    parser.add_argument("--core_id", type=int, default=None,
+                        help="First CPU core of the processes of this node. If not set, the processes are "
+                             "not bound to cores.")
+    parser.add_argument("--cores_per_proc", type=int, default=1,
+                        help="Consecutive cores bound to each process, starting at --core_id. The "
+                             "training loop keeps the first one and DataLoader workers are pinned "
+                             "to the others (see --num_workers of the training scripts). Processes that "
+                             "train on the CPU (--no_cuda) use all of their cores for compute.")
+    parser.add_argument("--stage_dir", type=str, default=None,
+                        help="Node-local directory (e.g. /dev/shm/bert-race). If set, the launcher copies "
+                             "the files named by --stage_args there once per node before starting the "
+                             "processes, and points the training script at the local copies.")
+    parser.add_argument("--stage_args", type=str, nargs="+",
+                        default=["bert_model", "vocab_file", "feature_cache_dir"],
+                        help="Training script arguments whose file or directory is staged to --stage_dir.")
 
     # positional
     parser.add_argument("training_script", type=str,
@@ -199,9 +218,117 @@ def parse_args():
     return parser.parse_args()
 
 
+def _is_current(src, dst):
+    """
+    True if dst is a copy or hard link of src with the same size and mtime
+    """
+    if not os.path.exists(dst):
+        return False
+    src_stat, dst_stat = os.stat(src), os.stat(dst)
+    if (src_stat.st_dev, src_stat.st_ino) == (dst_stat.st_dev, dst_stat.st_ino):
+        return True
+    return src_stat.st_size == dst_stat.st_size and src_stat.st_mtime_ns == dst_stat.st_mtime_ns
+
+
+def _stage_file(src, dst):
+    """
+    Hard links src to dst on the same file system, copies it otherwise;
+    the copy is written next to dst and renamed into place
+    """
+    if _is_current(src, dst):
+        return False
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    fd, temp_name = tempfile.mkstemp(dir=os.path.dirname(dst), prefix=".stage-")
+    os.close(fd)
+    os.remove(temp_name)
+    try:
+        try:
+            os.link(src, temp_name)
+        except OSError:
+            shutil.copy2(src, temp_name)
+        os.replace(temp_name, dst)
+    finally:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+    return True
+
+
+def stage_path(path, stage_dir):
+    """
+    Mirrors a file or directory from shared storage into stage_dir and
+    returns the local path. Files that are already up to date (same size
+    and mtime) are not copied again, so restarts only pay for what changed.
+    """
+    src = os.path.abspath(path)
+    digest = hashlib.sha256(os.path.dirname(src).encode("utf-8")).hexdigest()[:8]
+    dst = os.path.join(os.path.abspath(stage_dir), digest, os.path.basename(src))
+    copied = total = 0
+    if os.path.isdir(src):
+        os.makedirs(dst, exist_ok=True)
+        for root, _, files in os.walk(src):
+            for name in files:
+                relative = os.path.relpath(os.path.join(root, name), src)
+                copied += _stage_file(os.path.join(src, relative), os.path.join(dst, relative))
+                total += 1
+    else:
+        copied += _stage_file(src, dst)
+        total += 1
+    print("staged {} -> {} ({} of {} files copied)".format(path, dst, copied, total))
+    return dst
+
+
+def stage_training_args(training_script_args, stage_names, stage_dir):
+    """
+    Returns training_script_args with the paths of the --<name> arguments in
+    stage_names replaced by node-local copies. Both "--name=value" and
+    "--name value" are recognized; paths that do not exist are left as they are.
+    """
+    staged_args = list(training_script_args)
+    for i, arg in enumerate(staged_args):
+        for name in stage_names:
+            option = "--" + name
+            if arg.startswith(option + "="):
+                value_index, value = i, arg[len(option) + 1:]
+            elif arg == option and i + 1 < len(staged_args):
+                value_index, value = i + 1, staged_args[i + 1]
+            else:
+                continue
+            if not os.path.exists(value):
+                print("not staging {}: {} does not exist".format(option, value))
+                continue
+            local = stage_path(value, stage_dir)
+            if value_index == i:
+                staged_args[i] = "{}={}".format(option, local)
+            else:
+                staged_args[value_index] = local
+    return staged_args
+
+
+def bind_cores(first_core, num_cores):
+    """
+    Returns the command prefix and the preexec_fn that bind a process to
+    num_cores cores from first_core: numactl (with node-local memory) when it
+    is installed, sched_setaffinity in the child otherwise, and no binding
+    where neither exists (e.g. macOS)
+    """
+    if shutil.which("numactl"):
+        cores = "{}-{}".format(first_core, first_core + num_cores - 1) if num_cores > 1 else str(first_core)
+        return ["numactl", "--physcpubind", cores, "--localalloc"], None
+    if hasattr(os, "sched_setaffinity"):
+        cores = set(range(first_core, first_core + num_cores))
+        return [], lambda: os.sched_setaffinity(0, cores)
+    print("cannot bind the processes to cores: neither numactl nor sched_setaffinity is available")
+    return [], None
+
+
 def main():
     args = parse_args()
 
+    # the launcher runs once per node: stage the inputs before any process starts
+    training_script_args = args.training_script_args
+    if args.stage_dir is not None:
+        training_script_args = stage_training_args(training_script_args, args.stage_args, args.stage_dir)
+
     # world size in terms of number of processes
     dist_world_size = args.nproc_per_node * args.nnodes
 
@@ -210,11 +337,13 @@ def main():
     current_env["MASTER_ADDR"] = args.master_addr
     current_env["MASTER_PORT"] = str(args.master_port)
     current_env["WORLD_SIZE"] = str(dist_world_size)
+    # lets unbound processes share out the node's cores (see race_utils.set_worker_affinity)
+    current_env["LOCAL_WORLD_SIZE"] = str(args.nproc_per_node)
 
     processes = []
 
     if 'OMP_NUM_THREADS' not in os.environ and args.nproc_per_node > 1:
-        current_env["OMP_NUM_THREADS"] = str(1)
+        current_env["OMP_NUM_THREADS"] = str(args.cores_per_proc)
         print("*****************************************\n"
               "Setting OMP_NUM_THREADS environment variable for each process "
               "to be {} in default, to avoid your system being overloaded, "
@@ -230,7 +359,9 @@ def main():
 
         # spawn the processes
         with_python = not args.no_python
-        cmd = ["numactl", "--physcpubind", str(local_rank + args.core_id), "--localalloc"]
+        cmd, preexec_fn = [], None
+        if args.core_id is not None:
+            cmd, preexec_fn = bind_cores(args.core_id + local_rank * args.cores_per_proc, args.cores_per_proc)
         if with_python:
             cmd += [sys.executable, "-u"]
             if args.module:
@@ -246,9 +377,9 @@ def main():
         if not args.use_env:
             cmd.append("--local_rank={}".format(local_rank))
 
-        cmd.extend(args.training_script_args)
+        cmd.extend(training_script_args)
 
-        process = subprocess.Popen(cmd, env=current_env)
+        process = subprocess.Popen(cmd, env=current_env, preexec_fn=preexec_fn)
         processes.append(process)
 
     for process in processes:
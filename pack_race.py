@@ -0,0 +1,32 @@
+# coding=utf-8
+"""Packs a RACE data directory into one archive file with an offset index.
+
+The runners and test_race.py accept the archive in place of the directory,
+e.g. `--data_dir=./RACE.pack`, and read the files through a memory map.
+"""
+
+import argparse
+import logging
+
+from pytorch_pretrained_bert.race_utils import pack_race_archive
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt='%m/%d/%Y %H:%M:%S',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", default=None, type=str, required=True,
+                        help="The data dir to pack, containing train/dev/test.")
+    parser.add_argument("--output_file", default=None, type=str, required=True,
+                        help="The archive to write, e.g. ./RACE.pack")
+    args = parser.parse_args()
+
+    num_files = pack_race_archive(args.data_dir, args.output_file)
+    logger.info("packed {} files from {} into {}".format(num_files, args.data_dir, args.output_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""Resumable training checkpoints written off the training thread.
+
+A checkpoint is a directory `checkpoint-{global_step}` in the output
+directory. The main process writes `training_state.pt` (model, optimizer,
+scheduler and amp state plus the position in the epoch); every process
+writes its own `rng-{rank}.pt`. `AsyncCheckpointer.save` only queues the
+copies of the state to the host; serializing and writing them happens in a
+background thread while training goes on.
+"""
+
+import os
+import re
+import random
+import shutil
+import inspect
+import logging
+import threading
+
+import numpy as np
+import torch
+
+from .utils import atomic_write
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_PREFIX = "checkpoint-"
+STATE_NAME = "training_state.pt"
+RNG_NAME = "rng-{}.pt"
+
+
+def get_rng_state():
+    """Returns the Python, NumPy, torch and CUDA random number generator states."""
+    state = {'python': random.getstate(),
+             'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """Restores the generator states returned by `get_rng_state`."""
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def _to_host(obj):
+    """Copies every tensor in a (nested) state dict to host memory; device copies are not waited for."""
+    if torch.is_tensor(obj):
+        if obj.is_cuda:
+            return obj.detach().to('cpu', non_blocking=True)
+        return obj.detach().clone()
+    if isinstance(obj, dict):
+        return type(obj)((key, _to_host(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_host(value) for value in obj)
+    return obj
+
+
+def _torch_load(filename):
+    # torch>=2.6 only unpickles tensors by default, the RNG states are Python and NumPy objects
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        return torch.load(filename, map_location='cpu', weights_only=False)
+    return torch.load(filename, map_location='cpu')
+
+
+def checkpoint_path(output_dir, global_step):
+    return os.path.join(output_dir, "{}{}".format(CHECKPOINT_PREFIX, global_step))
+
+
+def list_checkpoints(output_dir):
+    """Returns the `(global_step, path)` of the checkpoints in `output_dir`, oldest first."""
+    if not os.path.isdir(output_dir):
+        return []
+    checkpoints = []
+    for name in os.listdir(output_dir):
+        match = re.match(re.escape(CHECKPOINT_PREFIX) + r"(\d+)$", name)
+        if match:
+            checkpoints.append((int(match.group(1)), os.path.join(output_dir, name)))
+    return sorted(checkpoints)
+
+
+def is_complete(path, world_size=1):
+    """Whether all `world_size` processes have finished writing the checkpoint in `path`."""
+    return os.path.exists(os.path.join(path, STATE_NAME)) and \
+        all(os.path.exists(os.path.join(path, RNG_NAME.format(rank))) for rank in range(world_size))
+
+
+def find_latest_checkpoint(output_dir, world_size=1):
+    """Returns the newest checkpoint written completely by all `world_size` processes, or None."""
+    for _, path in reversed(list_checkpoints(output_dir)):
+        if is_complete(path, world_size):
+            return path
+    return None
+
+
+def load_checkpoint(path, rank=0):
+    """Returns the training state and the RNG state of process `rank` saved in `path`, on the CPU."""
+    return _torch_load(os.path.join(path, STATE_NAME)), _torch_load(os.path.join(path, RNG_NAME.format(rank)))
+
+
+class AsyncCheckpointer(object):
+    """Writes checkpoints to `output_dir` from a background thread.
+
+    At most one checkpoint is in flight: `save` first waits for the previous
+    one. The process that writes the training state keeps the `keep` newest
+    checkpoints that all `world_size` processes have completed and removes
+    the ones older than those; newer ones may still be written by slower
+    processes and are left alone. A failure of the writer thread is raised
+    by the next `save` or by `wait`.
+    """
+
+    def __init__(self, output_dir, rank=0, keep=2, world_size=1):
+        self.output_dir = output_dir
+        self.rank = rank
+        self.world_size = world_size
+        self.keep = keep
+        self._thread = None
+        self._error = None
+
+    def save(self, global_step, state=None):
+        """Checkpoints `state` (main process only, None elsewhere) and this process's RNG state.
+
+        Must be called between optimizer steps: the tensors are copied in
+        stream order, so later updates of the parameters do not leak into
+        the checkpoint.
+        """
+        self.wait()
+        snapshot = _to_host(state) if state is not None else None
+        event = None
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            event = torch.cuda.Event()
+            event.record()
+        rng = get_rng_state()
+        self._thread = threading.Thread(target=self._write, args=(global_step, snapshot, rng, event),
+                                        name="checkpoint-writer")
+        self._thread.start()
+
+    def wait(self):
+        """Blocks until the checkpoint in flight is written."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write(self, global_step, snapshot, rng, event):
+        try:
+            if event is not None:
+                event.synchronize()
+            path = checkpoint_path(self.output_dir, global_step)
+            atomic_write(os.path.join(path, RNG_NAME.format(self.rank)), lambda f: torch.save(rng, f))
+            if snapshot is not None:
+                atomic_write(os.path.join(path, STATE_NAME), lambda f: torch.save(snapshot, f))
+                logger.info("Saved checkpoint %s", path)
+                self._prune()
+        except BaseException as e:
+            self._error = e
+
+    def _prune(self):
+        if self.keep <= 0:
+            return
+        checkpoints = list_checkpoints(self.output_dir)
+        complete = [step for step, path in checkpoints if is_complete(path, self.world_size)]
+        if len(complete) < self.keep:
+            return
+        oldest_kept = complete[-self.keep]
+        for step, path in checkpoints:
+            if step < oldest_kept:
+                shutil.rmtree(path, ignore_errors=True)
@@ -17,10 +17,7 @@ from functools import wraps
 from hashlib import sha256
 from io import open
 
-import boto3
-from botocore.config import Config
-from botocore.exceptions import ClientError
-import requests
+# boto3 and requests are imported by the functions that download, not with the package
 from tqdm import tqdm
 
 try:
@@ -176,6 +173,7 @@ def s3_request(func):
 
     @wraps(func)
     def wrapper(url, *args, **kwargs):
+        from botocore.exceptions import ClientError
         try:
             return func(url, *args, **kwargs)
         except ClientError as exc:
@@ -190,6 +188,8 @@ def s3_request(func):
 @s3_request
 def s3_etag(url, proxies=None):
     """Check ETag on S3 object."""
+    import boto3
+    from botocore.config import Config
     s3_resource = boto3.resource("s3", config=Config(proxies=proxies))
     bucket_name, s3_path = split_s3_path(url)
     s3_object = s3_resource.Object(bucket_name, s3_path)
@@ -199,12 +199,15 @@ def s3_etag(url, proxies=None):
 @s3_request
 def s3_get(url, temp_file, proxies=None):
     """Pull a file directly from S3."""
+    import boto3
+    from botocore.config import Config
     s3_resource = boto3.resource("s3", config=Config(proxies=proxies))
     bucket_name, s3_path = split_s3_path(url)
     s3_resource.Bucket(bucket_name).download_fileobj(s3_path, temp_file)
 
 
 def http_get(url, temp_file, proxies=None):
+    import requests
     req = requests.get(url, stream=True, proxies=proxies)
     content_length = req.headers.get('Content-Length')
     total = int(content_length) if content_length is not None else None
@@ -235,6 +238,7 @@ def get_from_cache(url, cache_dir=None, force_download=False, proxies=None):
     if url.startswith("s3://"):
         etag = s3_etag(url, proxies=proxies)
     else:
+        import requests
         try:
             response = requests.head(url, allow_redirects=True, proxies=proxies)
             if response.status_code != 200:
@@ -0,0 +1,77 @@
+"""Training metrics recorded off the hot path.
+
+`MetricsRecorder` keeps the per-step losses on the device and moves them to
+the host every `interval` steps with one copy. A background thread then
+appends them to `loss.txt` and the TensorBoard writer, so the training loop
+neither waits for the device nor does file I/O on every step.
+"""
+
+import queue
+import threading
+
+import torch
+
+
+class MetricsRecorder(object):
+    """Buffers per-step losses and writes them from a background thread.
+
+    Every recorded step produces one `f"{loss}\\n"` line in `loss_file` and
+    one `loss` scalar at its `global_step` in `writer` (if given), in the
+    same format and order as writing them directly. `last_loss` is the most
+    recent value that reached the host, e.g. for a progress bar.
+    """
+
+    def __init__(self, writer=None, loss_file="loss.txt", interval=50):
+        self.writer = writer
+        self.loss_file = loss_file
+        self.interval = max(1, interval)
+        self.last_loss = None
+        self._losses = []
+        self._steps = []
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="metrics-recorder", daemon=True)
+        self._thread.start()
+
+    def record(self, loss, global_step):
+        """Adds the loss of one step; does not synchronize with the device."""
+        self._losses.append(loss.detach().float().reshape(()))
+        self._steps.append(global_step)
+        if len(self._losses) >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Starts moving the buffered losses to the host and hands them to the writer thread."""
+        if not self._losses:
+            return
+        losses = torch.stack(self._losses)
+        event = None
+        if losses.is_cuda:
+            host = torch.empty(losses.shape, dtype=losses.dtype, pin_memory=True)
+            host.copy_(losses, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+            losses = host
+        self._queue.put((losses, event, self._steps))
+        self._losses, self._steps = [], []
+
+    def close(self):
+        """Writes everything still buffered and stops the writer thread."""
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            losses, event, steps = item
+            if event is not None:
+                event.synchronize()
+            values = losses.tolist()
+            with open(self.loss_file, "a", encoding="utf-8") as f:
+                f.write("".join(f"{value}\n" for value in values))
+            if self.writer is not None:
+                for value, step in zip(values, steps):
+                    self.writer.add_scalar('loss', value, global_step=step)
+            self.last_loss = values[-1]
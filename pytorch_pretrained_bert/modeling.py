@@ -23,6 +23,7 @@ import os
 import copy
 import json
 import math
+import functools
 import logging
 import tarfile
 import tempfile
@@ -33,6 +34,7 @@ from torch import nn
 from torch.nn import CrossEntropyLoss
 
 from .file_utils import cached_path
+from .modeling_utils import checkpoint_layer
 
 logger = logging.getLogger(__name__)
 
@@ -149,24 +151,30 @@ class BertConfig(object):
         """Serializes this instance to a JSON string."""
         return json.dumps(self.to_dict(), indent=2, sort_keys=True) + "\n"
 
-try:
-    from apex.normalization.fused_layer_norm import FusedLayerNorm as BertLayerNorm
-except ImportError:
-    print("Better speed can be achieved with apex installed from https://www.github.com/nvidia/apex.")
-    class BertLayerNorm(nn.Module):
-        def __init__(self, hidden_size, eps=1e-12):
-            """Construct a layernorm module in the TF style (epsilon inside the square root).
-            """
-            super(BertLayerNorm, self).__init__()
-            self.weight = nn.Parameter(torch.ones(hidden_size))
-            self.bias = nn.Parameter(torch.zeros(hidden_size))
-            self.variance_epsilon = eps
-
-        def forward(self, x):
-            u = x.mean(-1, keepdim=True)
-            s = (x - u).pow(2).mean(-1, keepdim=True)
-            x = (x - u) / torch.sqrt(s + self.variance_epsilon)
-            return self.weight * x + self.bias
+@functools.lru_cache(maxsize=None)
+def _fused_layer_norm():
+    """apex's fused layer norm kernel, or None; looked up on first use rather than at import."""
+    try:
+        from apex.normalization.fused_layer_norm import fused_layer_norm_affine
+    except ImportError:
+        return None
+    return fused_layer_norm_affine
+
+
+class BertLayerNorm(nn.LayerNorm):
+    def __init__(self, hidden_size, eps=1e-12):
+        """Construct a layernorm module in the TF style (epsilon inside the square root).
+        CUDA inputs go through apex's fused kernel when apex is installed, everything
+        else through torch's, which autocast also keeps in fp32 under bf16 on the CPU.
+        """
+        super(BertLayerNorm, self).__init__(hidden_size, eps=eps)
+
+    def forward(self, x):
+        if x.is_cuda:
+            fused_layer_norm = _fused_layer_norm()
+            if fused_layer_norm is not None:
+                return fused_layer_norm(x, self.weight, self.bias, self.normalized_shape, self.eps)
+        return super(BertLayerNorm, self).forward(x)
 
 class BertEmbeddings(nn.Module):
     """Construct the embeddings from word, position and token_type embeddings.
@@ -182,10 +190,11 @@ class BertEmbeddings(nn.Module):
         self.LayerNorm = BertLayerNorm(config.hidden_size, eps=1e-12)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
-    def forward(self, input_ids, token_type_ids=None):
-        seq_length = input_ids.size(1)
-        position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
-        position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
+    def forward(self, input_ids, token_type_ids=None, position_ids=None):
+        if position_ids is None:
+            seq_length = input_ids.size(1)
+            position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
+            position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
         if token_type_ids is None:
             token_type_ids = torch.zeros_like(input_ids)
 
@@ -322,11 +331,17 @@ class BertEncoder(nn.Module):
         super(BertEncoder, self).__init__()
         layer = BertLayer(config)
         self.layer = nn.ModuleList([copy.deepcopy(layer) for _ in range(config.num_hidden_layers)])
+        # recompute the activations of every k-th layer in backward (0: store all), see `set_activation_checkpointing`
+        self.checkpoint_every = 0
 
     def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True):
         all_encoder_layers = []
-        for layer_module in self.layer:
-            hidden_states = layer_module(hidden_states, attention_mask)
+        recompute = self.checkpoint_every > 0 and self.training and torch.is_grad_enabled()
+        for i, layer_module in enumerate(self.layer):
+            if recompute and i % self.checkpoint_every == 0:
+                hidden_states = checkpoint_layer(layer_module, hidden_states, attention_mask)
+            else:
+                hidden_states = layer_module(hidden_states, attention_mask)
             if output_all_encoded_layers:
                 all_encoder_layers.append(hidden_states)
         if not output_all_encoded_layers:
@@ -551,6 +566,18 @@ class PreTrainedBertModel(nn.Module):
         return model
 
 
+def block_diagonal_attention_mask(sequence_ids):
+    """Builds the boolean [batch_size, seq_len, seq_len] mask of packed rows.
+
+    `sequence_ids` numbers the sequences packed into every row (1, 2, ...;
+    0 for padding). A token may only attend to tokens of its own sequence.
+    The mask stays boolean (one byte per entry); `BertModel` turns it into
+    the additive mask in the model's dtype.
+    """
+    same_sequence = sequence_ids.unsqueeze(-1) == sequence_ids.unsqueeze(-2)
+    return same_sequence & (sequence_ids > 0).unsqueeze(-2)
+
+
 class BertModel(PreTrainedBertModel):
     """BERT model ("Bidirectional Embedding Representations from a Transformer").
     Params:
@@ -565,8 +592,12 @@ class BertModel(PreTrainedBertModel):
         `attention_mask`: an optional torch.LongTensor of shape [batch_size, sequence_length] with indices
             selected in [0, 1]. It's a mask to be used if the input sequence length is smaller than the max
             input sequence length in the current batch. It's the mask that we typically use for attention when
-            a batch has varying length sentences.
+            a batch has varying length sentences. A mask of shape [batch_size, sequence_length, sequence_length]
+            (long or bool) gives the keys every query may attend to, e.g. a block-diagonal mask for packed
+            sequences (see `block_diagonal_attention_mask`).
         `output_all_encoded_layers`: boolean which controls the content of the `encoded_layers` output as described below. Default: `True`.
+        `position_ids`: an optional torch.LongTensor of shape [batch_size, sequence_length] with the position
+            of every token, for packed sequences whose positions restart at each sequence. Default: 0, 1, 2...
     Outputs: Tuple of (encoded_layers, pooled_output)
         `encoded_layers`: controled by `output_all_encoded_layers` argument:
             - `output_all_encoded_layers=True`: outputs a list of the full sequences of encoded-hidden-states at the end
@@ -598,7 +629,8 @@ class BertModel(PreTrainedBertModel):
         self.apply(self.init_bert_weights)
         self.config = config
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True):
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True,
+                position_ids=None):
         if attention_mask is None:
             attention_mask = torch.ones_like(input_ids)
         if token_type_ids is None:
@@ -609,17 +641,28 @@ class BertModel(PreTrainedBertModel):
         # So we can broadcast to [batch_size, num_heads, from_seq_length, to_seq_length]
         # this attention mask is more simple than the triangular masking of causal attention
         # used in OpenAI GPT, we just need to prepare the broadcast dimension here.
-        extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
+        # A [batch_size, from_seq_length, to_seq_length] mask (packed sequences)
+        # only needs the head dimension.
+        if attention_mask.dim() == 3:
+            extended_attention_mask = attention_mask.unsqueeze(1)
+        else:
+            extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
 
         # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
         # masked positions, this operation will create a tensor which is 0.0 for
         # positions we want to attend and -10000.0 for masked positions.
         # Since we are adding it to the raw scores before the softmax, this is
         # effectively the same as removing these entirely.
-        extended_attention_mask = extended_attention_mask.to(dtype=next(self.parameters()).dtype) # fp16 compatibility
-        extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+        dtype = next(self.parameters()).dtype # fp16 compatibility
+        if extended_attention_mask.dtype == torch.bool:
+            # a boolean mask (packed sequences) is filled in directly, without an int/float copy of it
+            extended_attention_mask = extended_attention_mask.new_zeros(extended_attention_mask.shape, dtype=dtype) \
+                .masked_fill_(~extended_attention_mask, -10000.0)
+        else:
+            extended_attention_mask = extended_attention_mask.to(dtype=dtype)
+            extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
 
-        embedding_output = self.embeddings(input_ids, token_type_ids)
+        embedding_output = self.embeddings(input_ids, token_type_ids, position_ids)
         encoded_layers = self.encoder(embedding_output,
                                       extended_attention_mask,
                                       output_all_encoded_layers=output_all_encoded_layers)
@@ -890,9 +933,16 @@ class BertForMultipleChoice(PreTrainedBertModel):
             a batch has varying length sentences.
         `labels`: labels for the classification output: torch.LongTensor of shape [batch_size]
             with indices selected in [0, ..., num_choices].
+        `position_ids`, `cls_index`: packed mode, where the choices are packed several to a row.
+            `input_ids`, `token_type_ids` and `position_ids` are then of shape [num_rows, sequence_length],
+            `attention_mask` is the block-diagonal [num_rows, sequence_length, sequence_length] mask and
+            `cls_index` (torch.LongTensor of shape [batch_size * num_choices]) holds the flat position
+            (row * sequence_length + offset) of the [CLS] token of every choice, in batch/choice order.
+        `return_logits`: with `labels`, also return the logits, so evaluation needs a single forward pass.
     Outputs:
         if `labels` is not `None`:
-            Outputs the CrossEntropy classification loss of the output with the labels.
+            Outputs the CrossEntropy classification loss of the output with the labels,
+            or `(loss, logits)` if `return_logits` is set.
         if `labels` is `None`:
             Outputs the classification logits of shape [batch_size, num_labels].
     Example usage:
@@ -916,11 +966,18 @@ class BertForMultipleChoice(PreTrainedBertModel):
         self.classifier = nn.Linear(config.hidden_size, 1)
         self.apply(self.init_bert_weights)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels=None):
-        flat_input_ids = input_ids.view(-1, input_ids.size(-1))
-        flat_token_type_ids = token_type_ids.view(-1, token_type_ids.size(-1))
-        flat_attention_mask = attention_mask.view(-1, attention_mask.size(-1))
-        _, pooled_output = self.bert(flat_input_ids, flat_token_type_ids, flat_attention_mask, output_all_encoded_layers=False)
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels=None,
+                position_ids=None, cls_index=None, return_logits=False):
+        if cls_index is None:
+            flat_input_ids = input_ids.view(-1, input_ids.size(-1))
+            flat_token_type_ids = token_type_ids.view(-1, token_type_ids.size(-1))
+            flat_attention_mask = attention_mask.view(-1, attention_mask.size(-1))
+            _, pooled_output = self.bert(flat_input_ids, flat_token_type_ids, flat_attention_mask, output_all_encoded_layers=False)
+        else:
+            sequence_output, _ = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=False,
+                                           position_ids=position_ids)
+            cls_output = sequence_output.reshape(-1, sequence_output.size(-1)).index_select(0, cls_index)
+            pooled_output = self.bert.pooler(cls_output.unsqueeze(1))
         pooled_output = self.dropout(pooled_output)
         logits = self.classifier(pooled_output)
         reshaped_logits = logits.view(-1, self.num_choices)
@@ -928,6 +985,8 @@ class BertForMultipleChoice(PreTrainedBertModel):
         if labels is not None:
             loss_fct = CrossEntropyLoss()
             loss = loss_fct(reshaped_logits, labels)
+            if return_logits:
+                return loss, reshaped_logits
             return loss
         else:
             return reshaped_logits
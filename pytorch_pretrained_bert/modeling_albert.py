@@ -7,7 +7,7 @@ import sys
 import torch
 from torch import nn
 from torch.nn import CrossEntropyLoss, MSELoss
-from .modeling_utils import PreTrainedModel, prune_linear_layer
+from .modeling_utils import PreTrainedModel, prune_linear_layer, checkpoint_layer
 from .configuration_albert import AlbertConfig
 from .file_utils import add_start_docstrings
 logger = logging.getLogger(__name__)
@@ -318,16 +318,22 @@ class AlbertTransformer(nn.Module):
         self.num_hidden_layers = config.num_hidden_layers
         self.num_hidden_groups = config.num_hidden_groups
         self.group = nn.ModuleList([AlbertGroup(config) for _ in range(config.num_hidden_groups)])
+        # recompute the activations of every k-th layer in backward (0: store all), see `set_activation_checkpointing`
+        self.checkpoint_every = 0
 
     def forward(self, hidden_states, attention_mask, head_mask):
         all_hidden_states = ()
         all_attentions = ()
+        recompute = self.checkpoint_every > 0 and self.training and torch.is_grad_enabled()
         for layer_idx in range(self.num_hidden_layers):
             if self.output_hidden_states and layer_idx == 0:
                 all_hidden_states = all_hidden_states + (hidden_states,)
             group_idx = int(layer_idx / self.num_hidden_layers * self.num_hidden_groups)
             layer_module = self.group[group_idx]
-            layer_outputs = layer_module(hidden_states, attention_mask, head_mask[layer_idx])
+            if recompute and layer_idx % self.checkpoint_every == 0:
+                layer_outputs = checkpoint_layer(layer_module, hidden_states, attention_mask, head_mask[layer_idx])
+            else:
+                layer_outputs = layer_module(hidden_states, attention_mask, head_mask[layer_idx])
             hidden_states = layer_outputs[0][-1]
             if self.output_attentions:
                 all_attentions = all_attentions + layer_outputs[1]
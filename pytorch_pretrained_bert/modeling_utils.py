@@ -5,9 +5,11 @@ from __future__ import (absolute_import, division, print_function,
 
 import logging
 import os
+import inspect
 
 import torch
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 from torch.nn import CrossEntropyLoss
 from torch.nn import functional as F
 
@@ -753,3 +755,36 @@ def prune_layer(layer, index, dim=None):
         return prune_conv1d_layer(layer, index, dim=1 if dim is None else dim)
     else:
         raise ValueError("Can't prune layer of class {}".format(layer.__class__))
+
+
+# the non-reentrant variant (torch>=1.11) keeps nested outputs and works with DDP's unused parameter detection
+_CHECKPOINT_KWARGS = {'use_reentrant': False} if 'use_reentrant' in inspect.signature(checkpoint).parameters else {}
+
+
+def checkpoint_layer(layer, *inputs):
+    """ Runs `layer(*inputs)` without keeping its intermediate activations,
+        they are recomputed (with the same dropout masks) in backward.
+    """
+    return checkpoint(layer, *inputs, **_CHECKPOINT_KWARGS)
+
+
+def set_activation_checkpointing(model, every):
+    """ Makes the encoders of `model` recompute the activations of every
+        `every`-th layer in backward instead of storing them, starting at the
+        first layer (1 recomputes all layers, 0 stores all of them).
+        transformers models only support recomputing all layers.
+    """
+    encoders = [module for module in model.modules() if hasattr(module, 'checkpoint_every')]
+    for encoder in encoders:
+        encoder.checkpoint_every = every
+    if encoders:
+        return
+    if not hasattr(model, 'gradient_checkpointing_enable'):
+        raise ValueError("{} does not support activation checkpointing".format(model.__class__.__name__))
+    if every > 1:
+        logger.warning("%s recomputes the activations of all layers, not every %d-th",
+                       model.__class__.__name__, every)
+    if every > 0:
+        model.gradient_checkpointing_enable()
+    else:
+        model.gradient_checkpointing_disable()
@@ -0,0 +1,1208 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+# Copyright (c) 2018, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""RACE dataset reading and feature conversion shared by the runners."""
+
+import os
+import glob
+import time
+import queue
+import json
+import math
+import mmap
+import fnmatch
+import inspect
+import functools
+import random
+import itertools
+import struct
+import logging
+import hashlib
+import collections
+import threading
+import multiprocessing
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
+from torch.utils.data.dataloader import default_collate
+from tqdm import tqdm
+
+from .utils import is_main_process, is_local_main_process, get_rank, get_world_size, barrier, atomic_write
+from .modeling import block_diagonal_attention_mask
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the layout of the cached features changes.
+FEATURE_CACHE_VERSION = 5
+
+# Cache shards keep the token ids of every example long enough for this
+# sequence length; the features for any shorter `max_seq_length` are laid out
+# from them, so the corpus is tokenized once for all lengths.
+TOKEN_CACHE_MAX_SEQ_LENGTH = 512
+
+# Order of the tensors in the batches of `FeatureBatchDataset`.
+# `input_mask` and `segment_ids` are not stored: `batch_to_inputs` rebuilds
+# them from `seq_len` (real token count) and `doc_len` (truncated article).
+FEATURE_FIELDS = ('input_ids', 'label', 'doc_len', 'ques_len', 'option_len', 'seq_len')
+
+_STORE_MAGIC = b"RACEFEAT"
+_STORE_ALIGN = 64
+
+_ARCHIVE_MAGIC = b"RACEPACK"
+
+
+class RaceExample(object):
+    """A single training/test example for the RACE dataset."""
+    '''
+    For RACE dataset:
+    race_id: data id
+    context_sentence: article
+    start_ending: question
+    ending_0/1/2/3: option_0/1/2/3
+    label: true answer
+    '''
+
+    def __init__(self,
+                 race_id,
+                 context_sentence,
+                 start_ending,
+                 ending_0,
+                 ending_1,
+                 ending_2,
+                 ending_3,
+                 label=None):
+        self.race_id = race_id
+        self.context_sentence = context_sentence
+        self.start_ending = start_ending
+        self.endings = [
+            ending_0,
+            ending_1,
+            ending_2,
+            ending_3,
+        ]
+        self.label = label
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        l = [
+            f"id: {self.race_id}",
+            f"article: {self.context_sentence}",
+            f"question: {self.start_ending}",
+            f"option_0: {self.endings[0]}",
+            f"option_1: {self.endings[1]}",
+            f"option_2: {self.endings[2]}",
+            f"option_3: {self.endings[3]}",
+        ]
+
+        if self.label is not None:
+            l.append(f"label: {self.label}")
+
+        return ", ".join(l)
+
+
+def _file_sha256(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class RaceArchive(object):
+    """Read-only view of a packed RACE archive (see `pack_race_archive`).
+
+    The archive is memory-mapped and its index maps every member name (a
+    path relative to the packed directory) to its offset, length and sha256,
+    so a member is read without any file system metadata lookup.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            if f.read(len(_ARCHIVE_MAGIC)) != _ARCHIVE_MAGIC:
+                raise ValueError("{} is not a RACE archive".format(filename))
+            index_len, = struct.unpack('<Q', f.read(8))
+            self.index = json.loads(f.read(index_len).decode('utf-8'))
+            self.data_start = len(_ARCHIVE_MAGIC) + 8 + index_len
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def list(self, directory, pattern="*"):
+        """Returns the sorted members directly under `directory` matching `pattern`."""
+        directory = directory.strip('/')
+        prefix = directory + '/' if directory else ''
+        return sorted(name for name in self.index
+                      if name.startswith(prefix) and '/' not in name[len(prefix):] and
+                      fnmatch.fnmatch(name[len(prefix):], pattern))
+
+    def sha256(self, name):
+        return self.index[name][2]
+
+    def read(self, name):
+        offset, length, _ = self.index[name]
+        start = self.data_start + offset
+        return self._mmap[start:start + length]
+
+
+def pack_race_archive(data_dir, archive_file):
+    """Packs every file under `data_dir` into the single file `archive_file`.
+
+    The file starts with an index of `name: [offset, length, sha256]` (names
+    relative to `data_dir`), followed by the raw bytes of every file.
+    """
+    names = []
+    for root, _, files in os.walk(data_dir):
+        for name in files:
+            names.append(os.path.relpath(os.path.join(root, name), data_dir).replace(os.sep, '/'))
+    names.sort()
+    index = collections.OrderedDict()
+    offset = 0
+    for name in tqdm(names, desc="Indexing: "):
+        filename = os.path.join(data_dir, name)
+        size = os.path.getsize(filename)
+        index[name] = [offset, size, _file_sha256(filename)]
+        offset += size
+    index_bytes = json.dumps(index).encode('utf-8')
+
+    def write(f):
+        f.write(_ARCHIVE_MAGIC + struct.pack('<Q', len(index_bytes)) + index_bytes)
+        for name in tqdm(names, desc="Packing: "):
+            with open(os.path.join(data_dir, name), 'rb') as src:
+                f.write(src.read())
+
+    atomic_write(archive_file, write)
+    return len(names)
+
+
+_archives = {}
+
+
+def open_race_archive(filename):
+    """Returns the `RaceArchive` of `filename`, opened once per process."""
+    key = (os.getpid(), os.path.abspath(filename))
+    if key not in _archives:
+        _archives[key] = RaceArchive(filename)
+    return _archives[key]
+
+
+def _is_archive(filename):
+    with open(filename, "rb") as f:
+        return f.read(len(_ARCHIVE_MAGIC)) == _ARCHIVE_MAGIC
+
+
+@functools.lru_cache(maxsize=None)
+def _split_archive_path(path):
+    """Splits `path` into `(archive file, member directory)` when it points
+    into a RACE archive, e.g. `RACE.pack/train/high`; returns None otherwise."""
+    head, members = os.path.normpath(path), []
+    while head and not os.path.exists(head):
+        head, tail = os.path.split(head)
+        members.insert(0, tail)
+    if head and os.path.isfile(head) and _is_archive(head):
+        return head, '/'.join(members)
+    return None
+
+
+def _archive_member(filename):
+    """Returns `(archive, member name)` for a file inside an archive, else None."""
+    location = _split_archive_path(os.path.dirname(filename))
+    if location is None:
+        return None
+    archive_file, directory = location
+    return open_race_archive(archive_file), '/'.join(filter(None, [directory, os.path.basename(filename)]))
+
+
+def read_race_source(filename):
+    """Returns the raw bytes of a data file, either on disk or inside an archive."""
+    member = _archive_member(filename)
+    if member is not None:
+        archive, name = member
+        return archive.read(name)
+    with open(filename, 'rb') as fpr:
+        return fpr.read()
+
+
+def read_race_file(filename):
+    """Reads the questions of one RACE json file into `RaceExample`s."""
+    examples = []
+    data_raw = json.loads(read_race_source(filename).decode('utf-8'))
+    # every question of the file shares this one article string
+    article = data_raw['article']
+    # for each qn
+    for i in range(len(data_raw['answers'])):
+        truth = ord(data_raw['answers'][i]) - ord('A')
+        question = data_raw['questions'][i]
+        options = data_raw['options'][i]
+        examples.append(
+            RaceExample(
+                race_id=filename+'-'+str(i),
+                context_sentence=article,
+                start_ending=question,
+
+                ending_0=options[0],
+                ending_1=options[1],
+                ending_2=options[2],
+                ending_3=options[3],
+                label=truth))
+    return examples
+
+
+def list_race_files(paths, pattern="*txt"):
+    """Returns the sorted files matching `pattern` under each of `paths`.
+
+    A path may also point into a packed archive (`RACE.pack/train/high`), in
+    which case the archive index is listed instead of the directory.
+    """
+    filenames = []
+    for path in paths:
+        location = None if os.path.isdir(path) else _split_archive_path(path)
+        if location is None:
+            filenames.extend(sorted(glob.glob(path+"/"+pattern)))
+        else:
+            archive_file, directory = location
+            archive = open_race_archive(archive_file)
+            filenames.extend(os.path.join(archive_file, name) for name in archive.list(directory, pattern))
+    return filenames
+
+
+# paths is a list containing all paths
+def read_race_examples(paths, pattern="*txt"):
+    """Reads every file matching `pattern` under `paths` (see `read_race_file`)."""
+    examples = []
+    for filename in list_race_files(paths, pattern):
+        examples.extend(read_race_file(filename))
+    return examples
+
+
+def tokenize_article(tokenizer, article, max_seq_length):
+    """Tokenizes only the part of `article` that can survive truncation.
+
+    Both truncation modes keep at most `max_seq_length - 3` article tokens and
+    give the same result for any article at least that long, so tokenizers
+    that support it stop after that many word pieces.
+    """
+    if _supports_max_tokens(type(tokenizer)):
+        return tokenizer.tokenize(article, max_tokens=max_seq_length - 3)
+    return tokenizer.tokenize(article)
+
+
+@functools.lru_cache(maxsize=None)
+def _supports_max_tokens(tokenizer_class):
+    return 'max_tokens' in inspect.signature(tokenizer_class.tokenize).parameters
+
+
+def group_examples_by_article(examples):
+    """Splits `examples` into runs of consecutive examples that share one article.
+
+    `read_race_examples` emits all questions of a passage next to each other,
+    so every run maps to a single file.
+    """
+    groups = []
+    for example in examples:
+        if groups and groups[-1][0].context_sentence == example.context_sentence:
+            groups[-1].append(example)
+        else:
+            groups.append([example])
+    return groups
+
+
+# State installed once per pool worker so the tokenizer is not pickled per task.
+_worker_state = {}
+
+
+def _init_encode_worker(tokenizer, max_seq_length):
+    _worker_state['tokenizer'] = tokenizer
+    _worker_state['max_seq_length'] = max_seq_length
+
+
+def encode_article_examples(examples, tokenizer, max_seq_length):
+    """Tokenizes the questions of one article into token ids, without truncation.
+
+    Returns `(article_ids, questions)` where every question is a tuple
+    `(question_ids, [option_ids, ...], label)`. The article is cut to the
+    `max_seq_length - 3` tokens that can survive truncation at that length.
+    """
+    article_ids = tokenizer.convert_tokens_to_ids(
+        tokenize_article(tokenizer, examples[0].context_sentence, max_seq_length))
+    questions = []
+    for example in examples:
+        question_ids = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(example.start_ending))
+        option_ids = [tokenizer.convert_tokens_to_ids(tokenizer.tokenize(ending)) for ending in example.endings]
+        questions.append((question_ids, option_ids, example.label))
+    return article_ids, questions
+
+
+def _token_dtype(ids):
+    return np.int16 if ids.size == 0 or ids.max() < np.iinfo(np.int16).max else np.int32
+
+
+def encoded_to_token_arrays(encoded):
+    """Packs a list of `encode_article_examples` results into flat NumPy arrays.
+
+    Every article is stored once: `article_index` maps each question to its
+    article, `*_ids` hold the concatenated token ids and `*_len` the length
+    of every piece, so `assemble_feature_arrays` can lay out the features for
+    any `max_seq_length` up to the one used for encoding.
+    """
+    questions = [question for _, article_questions in encoded for question in article_questions]
+    num_choices = len(questions[0][1]) if questions else 4
+    arrays = collections.OrderedDict()
+    arrays['article_ids'] = np.fromiter(
+        itertools.chain.from_iterable(article_ids for article_ids, _ in encoded), dtype=np.int32)
+    arrays['article_len'] = np.array([len(article_ids) for article_ids, _ in encoded], dtype=np.int32)
+    arrays['article_index'] = np.repeat(np.arange(len(encoded), dtype=np.int32),
+                                        [len(article_questions) for _, article_questions in encoded])
+    arrays['question_ids'] = np.fromiter(
+        itertools.chain.from_iterable(question[0] for question in questions), dtype=np.int32)
+    arrays['question_len'] = np.array([len(question[0]) for question in questions], dtype=np.int32)
+    arrays['option_ids'] = np.fromiter(
+        itertools.chain.from_iterable(itertools.chain.from_iterable(question[1]) for question in questions),
+        dtype=np.int32)
+    arrays['option_len'] = np.array([[len(option_ids) for option_ids in question[1]] for question in questions],
+                                    dtype=np.int32).reshape(len(questions), num_choices)
+    arrays['label'] = np.array([question[2] for question in questions], dtype=np.int16)
+    for field in ('article_ids', 'question_ids', 'option_ids'):
+        arrays[field] = arrays[field].astype(_token_dtype(arrays[field]))
+    return arrays
+
+
+def _ragged_copy(dst, dst_starts, src, src_starts, lengths):
+    """Copies `lengths[k]` items from `src[src_starts[k]:]` to `dst[dst_starts[k]:]` for every k at once."""
+    total = int(lengths.sum())
+    if total == 0:
+        return
+    segment_starts = np.cumsum(lengths) - lengths
+    within = np.arange(total) - np.repeat(segment_starts, lengths)
+    dst[np.repeat(dst_starts, lengths) + within] = src[np.repeat(src_starts, lengths) + within]
+
+
+def _starts(lengths):
+    lengths = np.asarray(lengths, dtype=np.int64)
+    return np.cumsum(lengths) - lengths
+
+
+def assemble_feature_arrays(token_arrays, max_seq_length, cls_id, sep_id, truncate_article_only=False):
+    """Builds the `FEATURE_FIELDS` arrays from `encoded_to_token_arrays` output.
+
+    Lays out `[CLS] article [SEP] question option [SEP]` for every choice of
+    every question into one preallocated `(N, num_choices, max_seq_length)`
+    array. Truncation, segment placement and padding are computed with NumPy
+    over the whole block; the Python work does not grow with the number of
+    questions. Token ids are stored as int16 when the vocabulary allows it
+    (BERT and ALBERT both do), lengths and labels as int16.
+
+    `max_seq_length` may be anything up to the length the tokens were encoded
+    for: cutting the article there first does not change the result of
+    either truncation mode.
+    """
+    option_len = np.asarray(token_arrays['option_len'], dtype=np.int64)
+    num_examples, num_choices = option_len.shape
+    max_length = max_seq_length - 3
+
+    article_index = np.asarray(token_arrays['article_index'], dtype=np.int64)
+    article_len = np.asarray(token_arrays['article_len'], dtype=np.int64)
+    question_len = np.asarray(token_arrays['question_len'], dtype=np.int64)
+    a = np.repeat(article_len[article_index], num_choices).reshape(num_examples, num_choices)
+    q = np.repeat(question_len, num_choices).reshape(num_examples, num_choices)
+    o = option_len
+    b = q + o
+
+    # Kept lengths. With `truncate_article_only` only the article is cut.
+    # Otherwise the longer sequence loses tokens until both are even, then
+    # they shrink in turns, so a short side is kept whole and two long sides
+    # end up with half of the budget each.
+    if truncate_article_only:
+        if (b > max_length).any():
+            raise IndexError("the second sequence alone is longer than {} tokens".format(max_length))
+        a_kept, b_kept = np.minimum(a, max_length - b), b
+    else:
+        half = max_length // 2
+        cases = [a + b <= max_length, (a > b) & (b <= half), (a <= b) & (a <= half)]
+        a_kept = np.select(cases, [a, max_length - b, a], max_length - half)
+        b_kept = np.select(cases, [b, b, max_length - a], half)
+    q_kept = np.minimum(q, b_kept)
+    o_kept = b_kept - q_kept
+    seq_len = a_kept + b_kept + 3
+
+    input_ids = np.zeros((num_examples, num_choices, max_seq_length), dtype=np.int32)
+    flat_ids = input_ids.reshape(-1)
+    rows = np.arange(num_examples * num_choices).reshape(num_examples, num_choices) * max_seq_length
+    flat_ids[rows] = cls_id
+    flat_ids[rows + a_kept + 1] = sep_id
+    flat_ids[rows + seq_len - 1] = sep_id
+    _ragged_copy(flat_ids, (rows + 1).ravel(), token_arrays['article_ids'],
+                 np.repeat(_starts(article_len)[article_index], num_choices), a_kept.ravel())
+    _ragged_copy(flat_ids, (rows + a_kept + 2).ravel(), token_arrays['question_ids'],
+                 np.repeat(_starts(question_len), num_choices), q_kept.ravel())
+    _ragged_copy(flat_ids, (rows + a_kept + 2 + q_kept).ravel(), token_arrays['option_ids'],
+                 _starts(o.ravel()), o_kept.ravel())
+
+    arrays = collections.OrderedDict()
+    arrays['input_ids'] = input_ids.astype(_token_dtype(input_ids))
+    arrays['label'] = np.array(token_arrays['label'], dtype=np.int16)
+    arrays['doc_len'] = a_kept.astype(np.int16)
+    # the question length is only recomputed when the pair had to be cut, as in the per-choice code
+    arrays['ques_len'] = np.where(a_kept + b_kept >= max_length, b_kept - o, q).astype(np.int16)
+    arrays['option_len'] = o.astype(np.int16)
+    arrays['seq_len'] = seq_len.astype(np.int16)
+    return arrays
+
+
+def _special_token_ids(tokenizer):
+    return tuple(tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"]))
+
+
+def _encode_article_in_worker(examples):
+    return encode_article_examples(examples, _worker_state['tokenizer'], _worker_state['max_seq_length'])
+
+
+def encode_examples(examples, tokenizer, max_seq_length, num_workers=1, chunksize=16):
+    """Tokenizes `examples` into the token arrays of `encoded_to_token_arrays`.
+
+    Articles are tokenized once per passage and, with `num_workers` > 1,
+    spread over a process pool (`chunksize` articles per task); the result
+    keeps the order of `examples`, exactly as in the serial path.
+    """
+    groups = group_examples_by_article(examples)
+    progress = tqdm(total=len(examples), desc="Preprocessing: ") if is_main_process() else None
+    encoded = []
+    if num_workers > 1 and len(groups) > 1:
+        with multiprocessing.Pool(num_workers,
+                                  initializer=_init_encode_worker,
+                                  initargs=(tokenizer, max_seq_length)) as pool:
+            for article in pool.imap(_encode_article_in_worker, groups, chunksize=chunksize):
+                encoded.append(article)
+                if progress is not None:
+                    progress.update(len(article[1]))
+    else:
+        for group in groups:
+            encoded.append(encode_article_examples(group, tokenizer, max_seq_length))
+            if progress is not None:
+                progress.update(len(group))
+    if progress is not None:
+        progress.close()
+    return encoded_to_token_arrays(encoded)
+
+
+def tokenizer_fingerprint(tokenizer):
+    """Returns a digest of the tokenizer class, its vocabulary and its casing."""
+    digest = hashlib.sha256()
+    digest.update("{}.{}".format(type(tokenizer).__module__, type(tokenizer).__qualname__).encode('utf-8'))
+    vocab = getattr(tokenizer, 'vocab', None)
+    if vocab is None and hasattr(tokenizer, 'get_vocab'):
+        vocab = tokenizer.get_vocab()
+    for token, index in sorted((vocab or {}).items(), key=lambda item: item[1]):
+        digest.update("{}\t{}\n".format(token, index).encode('utf-8'))
+    basic_tokenizer = getattr(tokenizer, 'basic_tokenizer', None)
+    do_lower_case = getattr(basic_tokenizer, 'do_lower_case', getattr(tokenizer, 'do_lower_case', None))
+    digest.update("do_lower_case={}".format(do_lower_case).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def feature_cache_key(input_digest, tokenizer, max_seq_length, truncate_article_only=False):
+    """Content address of the features built from the given inputs and settings.
+
+    With an empty `input_digest` this identifies the conversion settings alone.
+    """
+    digest = hashlib.sha256()
+    for part in (FEATURE_CACHE_VERSION, input_digest, tokenizer_fingerprint(tokenizer),
+                 max_seq_length, truncate_article_only):
+        digest.update("{}\n".format(part).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _align(offset):
+    return (offset + _STORE_ALIGN - 1) // _STORE_ALIGN * _STORE_ALIGN
+
+
+def save_feature_arrays(arrays, filename):
+    """Writes named arrays into one binary file: magic, JSON header, then each
+    array contiguous and 64-byte aligned. The file is written atomically."""
+    header = collections.OrderedDict()
+    offset = 0
+    for name, array in arrays.items():
+        offset = _align(offset)
+        header[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += array.nbytes
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _align(len(_STORE_MAGIC) + 8 + len(header_bytes))
+
+    def write(f):
+        f.write(_STORE_MAGIC + struct.pack('<Q', len(header_bytes)) + header_bytes)
+        for name, array in arrays.items():
+            f.write(b'\0' * (data_start + header[name]['offset'] - f.tell()))
+            f.write(np.ascontiguousarray(array).tobytes())
+
+    atomic_write(filename, write)
+
+
+def load_feature_arrays(filename):
+    """Memory-maps the arrays written by `save_feature_arrays`.
+
+    Arrays are mapped copy-on-write: nothing is read until it is touched, and
+    processes that map the same file share its pages through the page cache.
+    """
+    with open(filename, "rb") as f:
+        magic = f.read(len(_STORE_MAGIC))
+        if magic != _STORE_MAGIC:
+            raise ValueError("{} is not a feature store file".format(filename))
+        header_len, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_len).decode('utf-8'), object_pairs_hook=collections.OrderedDict)
+    data_start = _align(len(_STORE_MAGIC) + 8 + header_len)
+    arrays = collections.OrderedDict()
+    for name, info in header.items():
+        dtype, shape = np.dtype(info['dtype']), tuple(info['shape'])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(filename, dtype=dtype, mode='c', offset=data_start + info['offset'], shape=shape)
+    return arrays
+
+
+def subset_feature_arrays(arrays, indices):
+    """Selects the examples at `indices` (a slice keeps the memory mapping)."""
+    return collections.OrderedDict((name, array[indices]) for name, array in arrays.items())
+
+
+class FeatureBatchDataset(Dataset):
+    """Feature arrays indexed by whole batches.
+
+    `dataset[indices]` gathers the `FEATURE_FIELDS` of a list of examples
+    with one `index_select` per field, instead of one `__getitem__` per
+    sample followed by stacking in `default_collate`. Drive it with a batch
+    sampler given as `sampler` and `batch_size=None`:
+
+        DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, False), batch_size=None)
+
+    `transform` (e.g. `trim_padding` or `pack_choices`) is applied to every
+    gathered batch. `len(dataset)` is the number of examples, so per-example
+    samplers can be built on it as usual.
+    """
+
+    def __init__(self, arrays, transform=None):
+        self.tensors = [torch.from_numpy(arrays[name]) for name in FEATURE_FIELDS]
+        self.transform = transform
+
+    def __len__(self):
+        return self.tensors[0].size(0)
+
+    def __getitem__(self, indices):
+        index = torch.as_tensor(indices, dtype=torch.long)
+        batch = tuple(tensor.index_select(0, index) for tensor in self.tensors)
+        if self.transform is not None:
+            batch = self.transform(batch)
+        return batch
+
+
+class CachedEvalBatches(object):
+    """Evaluation batches built once and kept as ready tensors.
+
+    Takes a fixed subset of `num_examples` examples drawn with `seed` (all
+    of them when `num_examples` is 0 or not smaller than the set), batches
+    them in order, or by length with `trim_padding` applied when `trim` is
+    set, and moves every batch to `device`. Each evaluation then only runs
+    the forward passes. Iterating yields the batches `batch_to_inputs` takes.
+    """
+
+    def __init__(self, arrays, batch_size, num_examples=0, seed=0, trim=False, device=None):
+        self.total_examples = len(arrays['label'])
+        if 0 < num_examples < self.total_examples:
+            arrays = subset_feature_arrays(
+                arrays, sorted(random.Random(seed).sample(range(self.total_examples), num_examples)))
+        self.num_examples = len(arrays['label'])
+        data = FeatureBatchDataset(arrays, transform=trim_padding if trim else None)
+        if trim:
+            batch_sampler = LengthBucketBatchSampler(range(self.num_examples), example_lengths(arrays),
+                                                     batch_size, shuffle=False)
+        else:
+            batch_sampler = [list(range(start, min(start + batch_size, self.num_examples)))
+                             for start in range(0, self.num_examples, batch_size)]
+        self.batches = []
+        for indices in batch_sampler:
+            batch = data[indices]
+            if device is not None:
+                batch = tuple(t.to(device) for t in batch)
+            self.batches.append(batch)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+
+def set_worker_affinity(worker_id):
+    """`worker_init_fn` that pins each DataLoader worker to its own core.
+
+    Workers inherit the CPU set of the training process. A set smaller than
+    the machine is taken to be the rank's own (e.g. from `numactl
+    --physcpubind` with launch.py `--core_id`); a rank that has the whole
+    machine shares it with the other `LOCAL_WORLD_SIZE` ranks of the node
+    and only uses the `LOCAL_RANK`-th slice of it. The workers are spread
+    over all but the first core of that set or slice, so they stay off
+    that core; the training process itself is not restricted. With a
+    single core there is nothing to spread and the binding is kept.
+    """
+    if not hasattr(os, 'sched_getaffinity'):
+        return
+    cores = sorted(os.sched_getaffinity(0))
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+    if local_world_size > 1 and len(cores) >= (os.cpu_count() or 0):
+        local_rank = int(os.environ.get("LOCAL_RANK", 0))
+        per_rank = len(cores) // local_world_size
+        cores = cores[local_rank * per_rank:(local_rank + 1) * per_rank]
+    if len(cores) > 1:
+        os.sched_setaffinity(0, {cores[1 + worker_id % (len(cores) - 1)]})
+
+
+class BackgroundPrefetcher(object):
+    """Iterates a DataLoader from a background thread, `depth` batches ahead.
+
+    With a CUDA `device` the thread also copies every batch to the device on
+    its own stream, so the next batch is fetched and transferred while the
+    current step runs. `wait_time` accumulates the time the training loop
+    spent waiting for batches and `steps` the batches it received, so
+    `wait_time / steps` is the data-wait time per step. With `depth=0` the
+    loader is iterated in place and only the waiting is measured.
+    """
+
+    def __init__(self, loader, device=None, depth=2):
+        self.loader = loader
+        self.device = device
+        self.depth = depth
+        self.wait_time = 0.0
+        self.steps = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, batch, stream):
+        with torch.cuda.stream(stream):
+            batch = tuple(t.to(self.device, non_blocking=True) for t in batch)
+            event = torch.cuda.Event()
+            event.record(stream)
+        return batch, event
+
+    @staticmethod
+    def _put(batches, item, stop):
+        # gives up once the training loop has stopped consuming
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, batches, stop):
+        stream = torch.cuda.Stream(self.device) if self.device is not None and self.device.type == "cuda" else None
+        try:
+            for batch in self.loader:
+                item = self._to_device(batch, stream) if stream is not None else (batch, None)
+                if not self._put(batches, item, stop):
+                    return
+            self._put(batches, StopIteration(), stop)
+        except Exception as error:
+            self._put(batches, error, stop)
+
+    def _iter_in_place(self):
+        batches = iter(self.loader)
+        while True:
+            start = time.perf_counter()
+            batch = next(batches, None)
+            self.wait_time += time.perf_counter() - start
+            if batch is None:
+                return
+            self.steps += 1
+            yield batch
+
+    def __iter__(self):
+        if self.depth <= 0:
+            yield from self._iter_in_place()
+            return
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = batches.get()
+                self.wait_time += time.perf_counter() - start
+                if isinstance(item, StopIteration):
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                batch, event = item
+                if event is not None:
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(event)
+                    for t in batch:
+                        t.record_stream(stream)
+                self.steps += 1
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+
+def lengths_to_masks(seq_len, doc_len, max_seq_length):
+    """Rebuilds `input_mask` and `segment_ids` from the per-choice lengths.
+
+    A choice is laid out as `[CLS] article [SEP] question option [SEP] pad...`,
+    so the mask covers the first `seq_len` positions and segment B starts
+    right after the article and its `[SEP]`, at `doc_len + 2`.
+    """
+    positions = torch.arange(max_seq_length, device=seq_len.device)
+    input_mask = positions < seq_len.unsqueeze(-1)
+    segment_ids = (positions >= (doc_len + 2).unsqueeze(-1)) & input_mask
+    return input_mask.long(), segment_ids.long()
+
+
+def batch_to_inputs(batch, device):
+    """Moves a batch of `FeatureBatchDataset` (or `RaceStreamingDataset`) to `device`.
+
+    Returns `(input_ids, input_mask, segment_ids, label, doc_len, ques_len,
+    option_len)` as long tensors, with the masks built on the device.
+    """
+    input_ids, label, doc_len, ques_len, option_len, seq_len = (t.to(device).long() for t in batch)
+    input_mask, segment_ids = lengths_to_masks(seq_len, doc_len, input_ids.size(-1))
+    return input_ids, input_mask, segment_ids, label, doc_len, ques_len, option_len
+
+
+def example_lengths(arrays):
+    """Real length of every example: the longest of its four choices."""
+    return np.asarray(arrays['seq_len']).max(axis=-1)
+
+
+class LengthBucketBatchSampler(Sampler):
+    """Groups examples of similar length into the same batch.
+
+    Indices are drawn from `sampler` (a `RandomSampler`, `DistributedSampler`
+    or `SequentialSampler`) in chunks of `batch_size * bucket_size_multiplier`;
+    each chunk is sorted by `lengths` and cut into batches, and with
+    `shuffle` the batches are then shuffled per epoch. Together with
+    `trim_padding_collate` a batch is only padded to its own longest example.
+    """
+
+    def __init__(self, sampler, lengths, batch_size, drop_last=False, bucket_size_multiplier=50,
+                 shuffle=True, seed=0):
+        self.sampler = sampler
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def batches(self):
+        indices = list(self.sampler)
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = sorted(indices[start:start + self.bucket_size], key=lambda index: self.lengths[index])
+            for batch_start in range(0, len(bucket), self.batch_size):
+                batch = bucket[batch_start:batch_start + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        num_samples = len(self.sampler)
+        full_buckets, rest = divmod(num_samples, self.bucket_size)
+        if self.drop_last:
+            return full_buckets * (self.bucket_size // self.batch_size) + rest // self.batch_size
+        return full_buckets * int(math.ceil(self.bucket_size / self.batch_size)) + int(math.ceil(rest / self.batch_size))
+
+
+class ResumableBatchSampler(Sampler):
+    """Makes the batches of every epoch reproducible and lets an epoch start mid-way.
+
+    `set_epoch(epoch, skip)` forwards the epoch to `batch_sampler` (or the
+    `DistributedSampler` under it). Every iteration reseeds the generator of
+    a `RandomSampler` under it with `seed + epoch`, so an epoch always yields
+    the same batches, however often the DataLoader starts iterating (a
+    multi-worker DataLoader does twice on its first epoch). Iterations then
+    leave out the first `skip` batches; only their index lists are drawn,
+    their examples are not read.
+    """
+
+    def __init__(self, batch_sampler, seed=0):
+        self.batch_sampler = batch_sampler
+        self.seed = seed
+        self.epoch = 0
+        self.skip = 0
+
+    def set_epoch(self, epoch, skip=0):
+        self.epoch = epoch
+        self.skip = skip
+        sampler = getattr(self.batch_sampler, 'sampler', None)
+        if hasattr(self.batch_sampler, 'set_epoch'):
+            self.batch_sampler.set_epoch(epoch)
+        elif hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        sampler = getattr(self.batch_sampler, 'sampler', None)
+        if getattr(sampler, 'generator', None) is not None:
+            sampler.generator.manual_seed(self.seed + self.epoch)
+        return itertools.islice(iter(self.batch_sampler), self.skip, None)
+
+    def __len__(self):
+        return max(0, len(self.batch_sampler) - self.skip)
+
+
+def _round_up(length, multiple):
+    return (length + multiple - 1) // multiple * multiple
+
+
+def trim_padding_collate(batch, pad_to_multiple_of=8):
+    """Collates `FEATURE_FIELDS` samples, then applies `trim_padding`."""
+    return trim_padding(default_collate(batch), pad_to_multiple_of)
+
+
+def trim_padding(batch, pad_to_multiple_of=8):
+    """Cuts `input_ids` of a collated `FEATURE_FIELDS` batch to its longest
+    real sequence (rounded up to `pad_to_multiple_of`).
+
+    `batch_to_inputs` builds the masks from the trimmed width, so the model
+    simply sees shorter rows.
+    """
+    input_ids, label, doc_len, ques_len, option_len, seq_len = batch
+    length = min(_round_up(int(seq_len.max()), pad_to_multiple_of), input_ids.size(-1))
+    return input_ids[..., :length].contiguous(), label, doc_len, ques_len, option_len, seq_len
+
+
+def pack_choices_collate(batch, pad_to_multiple_of=8):
+    """Collates `FEATURE_FIELDS` samples, then applies `pack_choices`."""
+    return pack_choices(default_collate(batch), pad_to_multiple_of)
+
+
+def pack_choices(batch, pad_to_multiple_of=8):
+    """Packs the choices of a collated `FEATURE_FIELDS` batch into shared rows.
+
+    Every choice (`[CLS] article [SEP] question option [SEP]`, without its
+    padding) is placed first-fit, longest first, into rows of the original
+    width. Returns `(input_ids, token_type_ids, position_ids, sequence_ids,
+    cls_index, label, doc_len, ques_len, option_len)`: the first four are
+    [num_rows, width] with positions restarting at every choice and
+    `sequence_ids` numbering the choices of a row (0 for padding), and
+    `cls_index` is the flat [CLS] position of every choice in batch/choice
+    order. See `packed_batch_to_inputs`.
+    """
+    input_ids, label, doc_len, ques_len, option_len, seq_len = batch
+    max_seq_length = input_ids.size(-1)
+    flat_input_ids = input_ids.view(-1, max_seq_length)
+    lengths = seq_len.view(-1).tolist()
+    doc_lens = doc_len.view(-1).tolist()
+
+    free = []
+    placements = [None] * len(lengths)
+    for index in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        row = next((r for r, space in enumerate(free) if space >= lengths[index]), None)
+        if row is None:
+            free.append(max_seq_length)
+            row = len(free) - 1
+        placements[index] = (row, max_seq_length - free[row])
+        free[row] -= lengths[index]
+
+    width = min(_round_up(max_seq_length - min(free), pad_to_multiple_of), max_seq_length)
+    packed_input_ids = torch.zeros(len(free), width, dtype=input_ids.dtype)
+    token_type_ids = torch.zeros(len(free), width, dtype=torch.int8)
+    position_ids = torch.zeros(len(free), width, dtype=torch.int16)
+    sequence_ids = torch.zeros(len(free), width, dtype=torch.int16)
+    cls_index = torch.empty(len(lengths), dtype=torch.long)
+    positions = torch.arange(max_seq_length, dtype=torch.int16)
+    for index, (row, start) in enumerate(placements):
+        length, end = lengths[index], start + lengths[index]
+        packed_input_ids[row, start:end] = flat_input_ids[index, :length]
+        token_type_ids[row, start + doc_lens[index] + 2:end] = 1
+        position_ids[row, start:end] = positions[:length]
+        sequence_ids[row, start:end] = index + 1
+        cls_index[index] = row * width + start
+    return (packed_input_ids, token_type_ids, position_ids, sequence_ids, cls_index,
+            label, doc_len, ques_len, option_len)
+
+
+def packed_batch_to_inputs(batch, device):
+    """Moves a `pack_choices_collate` batch to `device`.
+
+    Returns `(input_ids, token_type_ids, attention_mask, position_ids,
+    cls_index, label)`, with the block-diagonal attention mask built on the
+    device, ready for `BertForMultipleChoice(..., position_ids=, cls_index=)`.
+    """
+    input_ids, token_type_ids, position_ids, sequence_ids, cls_index, label = \
+        (t.to(device).long() for t in batch[:6])
+    return (input_ids, token_type_ids, block_diagonal_attention_mask(sequence_ids), position_ids,
+            cls_index, label)
+
+
+def padding_stats(arrays, batches, max_seq_length, pad_to_multiple_of=8):
+    """Compares fixed padding to `max_seq_length` with per-batch trimming
+    over the examples of `batches` (lists of indices into `arrays`).
+
+    Returns the share of padding tokens in both cases and the ratio of
+    processed tokens (fixed / trimmed), an estimate of the speedup.
+    """
+    batches = [batch for batch in batches if len(batch)]
+    seq_len = np.asarray(arrays['seq_len'])
+    lengths = example_lengths(arrays)
+    num_choices = seq_len.shape[-1]
+    real_tokens = sum(int(seq_len[batch].sum(dtype=np.int64)) for batch in batches)
+    fixed_tokens = sum(len(batch) for batch in batches) * num_choices * max_seq_length
+    trimmed_tokens = sum(len(batch) * num_choices *
+                         min(_round_up(int(lengths[batch].max()), pad_to_multiple_of), max_seq_length)
+                         for batch in batches)
+    return {'padding_fixed': 1.0 - real_tokens / max(fixed_tokens, 1),
+            'padding_bucketed': 1.0 - real_tokens / max(trimmed_tokens, 1),
+            'speedup': fixed_tokens / max(trimmed_tokens, 1)}
+
+
+def _load_shard_index(index_file):
+    if os.path.exists(index_file):
+        with open(index_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return {'files': {}, 'hashes': {}}
+
+
+def _hash_source_files(filenames, index):
+    """Returns the content hash of every file, re-reading only the files whose
+    size or mtime differ from the ones recorded in `index` (updated in place).
+    Members of an archive come with their hash in the archive index."""
+    hashes = []
+    for filename in filenames:
+        member = _archive_member(filename)
+        if member is not None:
+            archive, name = member
+            hashes.append(archive.sha256(name))
+            continue
+        stat = os.stat(filename)
+        path = os.path.abspath(filename)
+        entry = index['files'].get(path)
+        if entry is None or entry['mtime_ns'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+            entry = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': _file_sha256(filename)}
+            index['files'][path] = entry
+        hashes.append(entry['sha256'])
+    return hashes
+
+
+def load_or_convert_features(filenames, tokenizer, max_seq_length, cache_dir, name="features",
+                             num_workers=1, truncate_article_only=False, read_fn=read_race_file,
+                             all_ranks=False):
+    """Returns `(arrays, file_offsets)` for the examples of `filenames`.
+
+    Set `all_ranks` when every distributed rank makes this call: the local
+    main process of each node then builds the cache while the other ranks
+    wait on a barrier, and all of them map the result afterwards.
+
+    Token ids are cached per source file, addressed by the file content
+    (found through its size and mtime, so unchanged files are not even read)
+    and by the tokenizer and reader. Only new or modified files are read with
+    `read_fn` and tokenized; they go into one new shard next to the existing
+    ones. Shards are not tied to `max_seq_length` (up to
+    `TOKEN_CACHE_MAX_SEQ_LENGTH`) or the truncation mode: the features of
+    `filenames` are laid out from them with `assemble_feature_arrays`,
+    concatenated in file order into a `name` store and memory-mapped from
+    there. The examples of `filenames[i]` are rows
+    `file_offsets[i]:file_offsets[i + 1]`.
+    """
+    if all_ranks and not is_local_main_process():
+        # wait for the local main process to build the cache, then only map it
+        barrier()
+        return _load_or_convert_features(filenames, tokenizer, max_seq_length, cache_dir, name,
+                                         num_workers, truncate_article_only, read_fn)
+    result = _load_or_convert_features(filenames, tokenizer, max_seq_length, cache_dir, name,
+                                       num_workers, truncate_article_only, read_fn)
+    if all_ranks:
+        barrier()
+    return result
+
+
+def _load_or_convert_features(filenames, tokenizer, max_seq_length, cache_dir, name, num_workers,
+                              truncate_article_only, read_fn):
+    # the reader is part of the shard settings: test_race.py parses the same files its own way
+    token_length = max(max_seq_length, TOKEN_CACHE_MAX_SEQ_LENGTH)
+    reader = "{}.{}".format(getattr(read_fn, '__module__', ''), getattr(read_fn, '__qualname__', ''))
+    settings_key = feature_cache_key(reader, tokenizer, token_length)
+    shard_dir = os.path.join(cache_dir, "shards-{}".format(settings_key[:16]))
+    index_file = os.path.join(shard_dir, "index.json")
+    index = _load_shard_index(index_file)
+    num_known_files = len(index['files'])
+    hashes = _hash_source_files(filenames, index)
+
+    missing = collections.OrderedDict()
+    for filename, file_hash in zip(filenames, hashes):
+        if file_hash not in index['hashes'] and file_hash not in missing:
+            missing[file_hash] = filename
+    if missing:
+        logger.info("tokenizing {} new or modified of {} files".format(len(missing), len(filenames)))
+        file_examples = [read_fn(filename) for filename in missing.values()]
+        token_arrays = encode_examples([example for examples in file_examples for example in examples],
+                                       tokenizer, token_length, num_workers=num_workers)
+        shard_name = "shard-{}.tokens".format(
+            hashlib.sha256("\n".join(missing).encode('utf-8')).hexdigest()[:32])
+        save_feature_arrays(token_arrays, os.path.join(shard_dir, shard_name))
+        del token_arrays
+        start = 0
+        for file_hash, examples in zip(missing, file_examples):
+            index['hashes'][file_hash] = [shard_name, start, start + len(examples)]
+            start += len(examples)
+    if missing or len(index['files']) != num_known_files:
+        atomic_write(index_file, lambda f: f.write(json.dumps(index).encode('utf-8')))
+
+    counts = [index['hashes'][file_hash][2] - index['hashes'][file_hash][1] for file_hash in hashes]
+    file_offsets = np.cumsum([0] + counts)
+    input_digest = hashlib.sha256("\n".join(hashes).encode('utf-8')).hexdigest()
+    key = feature_cache_key(input_digest, tokenizer, max_seq_length, truncate_article_only)
+    cache_file = os.path.join(cache_dir, "{}-{}.features".format(name, key[:32]))
+    if os.path.exists(cache_file):
+        logger.info("loading features from cache {}".format(cache_file))
+    else:
+        logger.info("assembling features into cache {}".format(cache_file))
+        cls_id, sep_id = _special_token_ids(tokenizer)
+        shards = {}
+        pieces = []
+        for file_hash in hashes:
+            shard_name, start, stop = index['hashes'][file_hash]
+            if shard_name not in shards:
+                shards[shard_name] = assemble_feature_arrays(load_feature_arrays(os.path.join(shard_dir, shard_name)),
+                                                             max_seq_length, cls_id, sep_id, truncate_article_only)
+            pieces.append(subset_feature_arrays(shards[shard_name], slice(start, stop)))
+        empty_shapes = {'input_ids': (0, 4, max_seq_length), 'label': (0,)}
+        arrays = collections.OrderedDict()
+        for field in FEATURE_FIELDS:
+            if pieces:
+                arrays[field] = np.concatenate([piece[field] for piece in pieces])
+            else:
+                arrays[field] = np.zeros(empty_shapes.get(field, (0, 4)), dtype=np.int16)
+        save_feature_arrays(arrays, cache_file)
+        del arrays, pieces, shards
+    return load_feature_arrays(cache_file), file_offsets
+
+
+def estimate_num_examples(filenames, sample_size=100, seed=0):
+    """Estimates the number of questions in `filenames` from a random sample of them."""
+    if not filenames:
+        return 0
+    sample = random.Random(seed).sample(filenames, min(sample_size, len(filenames)))
+    num_questions = sum(len(read_race_file(filename)) for filename in sample)
+    return int(round(num_questions * len(filenames) / len(sample)))
+
+
+def _shuffle_buffer(iterable, buffer_size, rng):
+    buffer = []
+    for item in iterable:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        index = rng.randrange(buffer_size)
+        yield buffer[index]
+        buffer[index] = item
+    rng.shuffle(buffer)
+    for item in buffer:
+        yield item
+
+
+class RaceStreamingDataset(IterableDataset):
+    """Reads and tokenizes RACE files lazily, one article at a time.
+
+    Files are sharded by `get_rank()`/`get_world_size()` and then among the
+    DataLoader workers of each rank, so tokenization runs in the workers and
+    only a `shuffle_buffer` of features is held in memory. Every rank yields
+    exactly `ceil(num_examples / world_size)` samples per epoch (cycling over
+    its files if needed) so that all ranks run the same number of steps.
+    Samples are tensors in `FEATURE_FIELDS` order, like the cached datasets,
+    so batches go through `batch_to_inputs` unchanged.
+    """
+
+    def __init__(self, filenames, tokenizer, max_seq_length, num_examples, shuffle=True,
+                 shuffle_buffer=1024, seed=42, truncate_article_only=False):
+        self.filenames = list(filenames)
+        self.tokenizer = tokenizer
+        self.max_seq_length = max_seq_length
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.truncate_article_only = truncate_article_only
+        self.rank = get_rank()
+        self.world_size = get_world_size()
+        self.num_samples = int(math.ceil(num_examples / self.world_size))
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_samples
+
+    def _shard(self):
+        files = list(self.filenames)
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(files)
+        # a shard without files (tiny corpora) falls back to the files of its rank
+        files = files[self.rank::self.world_size] or files
+        num_samples, worker_id = self.num_samples, 0
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            worker_id = worker_info.id
+            files = files[worker_id::worker_info.num_workers] or files
+            num_samples = (num_samples // worker_info.num_workers +
+                           int(worker_id < num_samples % worker_info.num_workers))
+        return files, num_samples, worker_id
+
+    def _features(self, files, rng):
+        cls_id, sep_id = _special_token_ids(self.tokenizer)
+        while True:
+            produced = False
+            for filename in files:
+                examples = read_race_file(filename)
+                if not examples:
+                    continue
+                encoded = encode_article_examples(examples, self.tokenizer, self.max_seq_length)
+                arrays = assemble_feature_arrays(encoded_to_token_arrays([encoded]), self.max_seq_length,
+                                                 cls_id, sep_id, self.truncate_article_only)
+                for i in range(len(examples)):
+                    produced = True
+                    yield tuple(arrays[field][i] for field in FEATURE_FIELDS)
+            if not produced:
+                return
+            if self.shuffle:
+                rng.shuffle(files)
+
+    @staticmethod
+    def _to_tensors(feature):
+        input_ids, label, doc_len, ques_len, option_len, seq_len = feature
+        return (torch.from_numpy(input_ids.astype(np.int32)),
+                torch.tensor(label, dtype=torch.int16),
+                torch.from_numpy(doc_len), torch.from_numpy(ques_len),
+                torch.from_numpy(option_len), torch.from_numpy(seq_len))
+
+    def __iter__(self):
+        files, num_samples, worker_id = self._shard()
+        rng = random.Random("{}-{}-{}-{}".format(self.seed, self.epoch, self.rank, worker_id))
+        stream = itertools.islice(self._features(files, rng), num_samples)
+        if self.shuffle:
+            stream = _shuffle_buffer(stream, self.shuffle_buffer, rng)
+        for feature in stream:
+            yield self._to_tensors(feature)
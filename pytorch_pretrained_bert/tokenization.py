@@ -63,6 +63,28 @@ def load_vocab(vocab_file):
     return vocab
 
 
+def tokenize_prefix(tokenize, text, max_tokens, chars_per_token=6):
+    """Returns `tokenize(text)[:max_tokens]` without tokenizing the whole text.
+
+    The text is tokenized in growing chunks that end on a space, which always
+    separates two tokens, so the chunks' tokens are exactly a prefix of the
+    tokens of the whole text. Tokenization stops once `max_tokens` are
+    produced.
+    """
+    tokens = []
+    start, chunk_size = 0, max(max_tokens, 1) * chars_per_token
+    while start < len(text) and len(tokens) < max_tokens:
+        end = start + chunk_size
+        if end < len(text):
+            cut = text.rfind(" ", start + 1, end)
+            if cut == -1:
+                cut = text.find(" ", end)
+            end = len(text) if cut == -1 else cut
+        tokens.extend(tokenize(text[start:end]))
+        start, chunk_size = end, chunk_size * 2
+    return tokens[:max_tokens]
+
+
 def whitespace_tokenize(text):
     """Runs basic whitespace cleaning and splitting on a peice of text."""
     text = text.strip()
@@ -89,7 +111,11 @@ class BertTokenizer(object):
         self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
         self.max_len = max_len if max_len is not None else int(1e12)
 
-    def tokenize(self, text):
+    def tokenize(self, text, max_tokens=None):
+        """Tokenizes `text`; with `max_tokens`, stops once that many word
+        pieces are produced and returns exactly the first `max_tokens`."""
+        if max_tokens is not None:
+            return tokenize_prefix(self.tokenize, text, max_tokens)
         split_tokens = []
         for token in self.basic_tokenizer.tokenize(text):
             for sub_token in self.wordpiece_tokenizer.tokenize(token):
@@ -8,6 +8,8 @@ import six
 import logging
 import sentencepiece as spm
 
+from .tokenization import tokenize_prefix
+
 logger = logging.getLogger(__name__)
 SPIECE_UNDERLINE = u"▁"
 
@@ -119,7 +121,14 @@ class FullTokenizer(object):
       self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab,unk_token="[UNK]", max_input_chars_per_word=100)
     self.inv_vocab = {v: k for k, v in self.vocab.items()}
 
-  def tokenize(self, text):
+  def tokenize(self, text, max_tokens=None):
+    """Tokenizes `text`; with `max_tokens`, stops once that many pieces are
+    produced and returns exactly the first `max_tokens`. Sentence pieces
+    do not cross whitespace (`split_by_whitespace`, the sentencepiece
+    default ALBERT's model is trained with), so like word pieces they can
+    be produced chunk by chunk."""
+    if max_tokens is not None:
+      return tokenize_prefix(self.tokenize, text, max_tokens)
     if self.sp_model:
       split_tokens = encode_pieces(self.sp_model, text, return_unicode=False)
     else:
@@ -11,6 +11,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import tempfile
+
 import torch
 import torch.distributed as dist
 
@@ -33,15 +36,87 @@ def get_world_size():
     return dist.get_world_size()
 
 
+def get_local_rank():
+    if not dist.is_available() or not dist.is_initialized():
+        return 0
+    return int(os.environ.get("LOCAL_RANK", 0))
+
+
 def is_main_process():
     return get_rank() == 0
 
 
+def is_local_main_process():
+    return get_local_rank() == 0
+
+
 def barrier():
     if dist.is_available() and dist.is_initialized():
         dist.barrier()
 
 
+def distributed_backend(device):
+    """NCCL between GPU processes, gloo between CPU processes."""
+    return 'nccl' if device.type == 'cuda' else 'gloo'
+
+
+def init_distributed(local_rank=-1, no_cuda=False):
+    """Picks the device of this process and, when started by launch.py
+    (`local_rank` != -1), joins the process group with the backend of that
+    device. Returns `(device, n_gpu)`.
+    """
+    use_cuda = torch.cuda.is_available() and not no_cuda
+    if local_rank == -1:
+        device = torch.device("cuda" if use_cuda else "cpu")
+        return device, torch.cuda.device_count() if use_cuda else 0
+    if use_cuda:
+        torch.cuda.set_device(local_rank)
+        device = torch.device("cuda", local_rank)
+    else:
+        device = torch.device("cpu")
+    dist.init_process_group(backend=distributed_backend(device), init_method='env://')
+    return device, 1 if use_cuda else 0
+
+
+def available_cores():
+    """Number of cores this process may run on, e.g. as bound by numactl in launch.py."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def tune_cpu_threads(num_threads=0, num_interop_threads=1):
+    """Sizes torch's intra-op and inter-op thread pools for training on the CPU.
+
+    `num_threads` of 0 uses the available cores, which also overrides the
+    `OMP_NUM_THREADS=1` launch.py sets for several processes per node. The
+    inter-op pool can only be sized before it is first used, later calls
+    keep its size. Returns both sizes.
+    """
+    if num_threads <= 0:
+        num_threads = available_cores()
+    torch.set_num_threads(num_threads)
+    if num_interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            pass
+    return torch.get_num_threads(), torch.get_num_interop_threads()
+
+
+def device_name(device):
+    if device.type == 'cuda':
+        return torch.cuda.get_device_name(device)
+    return "CPU, {} threads".format(torch.get_num_threads())
+
+
+def optimizer_params(optimizer):
+    """Yields the parameters of `optimizer`, like `apex.amp.master_params` without apex."""
+    for group in optimizer.param_groups:
+        for p in group['params']:
+            yield p
+
+
 def format_step(step):
     if isinstance(step, str):
         return step
@@ -59,6 +134,23 @@ def mkdir(path):
     Path(path).mkdir(parents=True, exist_ok=True)
 
 
+def atomic_write(filename, write_fn):
+    """Calls `write_fn(f)` on a temp file next to `filename`, then renames it into place."""
+    directory = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_name = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write_fn(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_name, filename)
+    except BaseException:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+
+
 def mkdir_by_main_process(path):
     if is_main_process():
         mkdir(path)
@@ -21,38 +21,34 @@ import logging
 import os
 import argparse
 import random
-import pickle
 
-import csv
-import glob
 import json
 import numpy as np
 import torch
 
-from tqdm import tqdm, trange
-from apex import amp
-from apex.multi_tensor_apply import multi_tensor_applier
-from torch.utils.data import TensorDataset, DataLoader, RandomSampler, SequentialSampler
+from tqdm import tqdm
+from torch.utils.data import DataLoader, RandomSampler, BatchSampler
 
 from torch.nn.parallel.distributed import DistributedDataParallel
 from torch.utils.data.distributed import DistributedSampler
 
-from pytorch_pretrained_bert.tokenization import BertTokenizer
-from pytorch_pretrained_bert.modeling import BertForMultipleChoice
-from pytorch_pretrained_bert.modeling import BertForMultipleChoiceWithMatch
 from pytorch_pretrained_bert.optimization import BertAdam
-from pytorch_pretrained_bert.optimization import RAdam
+from pytorch_pretrained_bert.modeling_utils import set_activation_checkpointing
 from pytorch_pretrained_bert.file_utils import PYTORCH_PRETRAINED_BERT_CACHE
 
-from pytorch_pretrained_bert.utils import is_main_process
+from pytorch_pretrained_bert.utils import is_main_process, get_rank, get_world_size
+from pytorch_pretrained_bert.utils import init_distributed, tune_cpu_threads, device_name, optimizer_params
+from pytorch_pretrained_bert.metrics import MetricsRecorder
+from pytorch_pretrained_bert.checkpoint import AsyncCheckpointer, find_latest_checkpoint, load_checkpoint
+from pytorch_pretrained_bert.checkpoint import set_rng_state
+from pytorch_pretrained_bert.race_utils import list_race_files, load_or_convert_features
+from pytorch_pretrained_bert.race_utils import subset_feature_arrays, FeatureBatchDataset, batch_to_inputs
+from pytorch_pretrained_bert.race_utils import example_lengths, LengthBucketBatchSampler, trim_padding, padding_stats
+from pytorch_pretrained_bert.race_utils import BackgroundPrefetcher, set_worker_affinity, CachedEvalBatches
+from pytorch_pretrained_bert.race_utils import ResumableBatchSampler
 
-from transformers import AdamW, get_linear_schedule_with_warmup
 from multiprocessing import cpu_count
 
-from transformers import AlbertTokenizer, AlbertForMultipleChoice
-
-from tensorboardX import SummaryWriter
-
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt='%m/%d/%Y %H:%M:%S',
                     level=logging.INFO)
@@ -64,233 +60,8 @@ SIMULATE = False
 NEW_MODEL = False  # Don't change!
 
 
-class RaceExample(object):
-    """A single training/test example for the RACE dataset."""
-    '''
-    For RACE dataset:
-    race_id: data id
-    context_sentence: article
-    start_ending: question
-    ending_0/1/2/3: option_0/1/2/3
-    label: true answer
-    '''
-
-    def __init__(self,
-                 race_id,
-                 context_sentence,
-                 start_ending,
-                 ending_0,
-                 ending_1,
-                 ending_2,
-                 ending_3,
-                 label=None):
-        self.race_id = race_id
-        self.context_sentence = context_sentence
-        self.start_ending = start_ending
-        self.endings = [
-            ending_0,
-            ending_1,
-            ending_2,
-            ending_3,
-        ]
-        self.label = label
-
-    def __str__(self):
-        return self.__repr__()
-
-    def __repr__(self):
-        l = [
-            f"id: {self.race_id}",
-            f"article: {self.context_sentence}",
-            f"question: {self.start_ending}",
-            f"option_0: {self.endings[0]}",
-            f"option_1: {self.endings[1]}",
-            f"option_2: {self.endings[2]}",
-            f"option_3: {self.endings[3]}",
-        ]
-
-        if self.label is not None:
-            l.append(f"label: {self.label}")
-
-        return ", ".join(l)
-
-
-class InputFeatures(object):
-    def __init__(self,
-                 example_id,
-                 choices_features,
-                 label
-
-                 ):
-        self.example_id = example_id
-        self.choices_features = [
-            {
-                'input_ids': input_ids,
-                'input_mask': input_mask,
-                'segment_ids': segment_ids,
-                'doc_len': doc_len,
-                'ques_len': ques_len,
-                'option_len': option_len
-            }
-            for _, input_ids, input_mask, segment_ids, doc_len, ques_len, option_len in choices_features
-        ]
-        self.label = label
-
-
-# paths is a list containing all paths
-def read_race_examples(paths):
-    examples = []
-    for path in paths:
-        filenames = glob.glob(path+"/*txt")
-        for filename in filenames:
-            with open(filename, 'r', encoding='utf-8') as fpr:
-                data_raw = json.load(fpr)
-                article = data_raw['article']
-                # for each qn
-                for i in range(len(data_raw['answers'])):
-                    truth = ord(data_raw['answers'][i]) - ord('A')
-                    question = data_raw['questions'][i]
-                    options = data_raw['options'][i]
-                    examples.append(
-                        RaceExample(
-                            race_id=filename+'-'+str(i),
-                            context_sentence=article,
-                            start_ending=question,
-
-                            ending_0=options[0],
-                            ending_1=options[1],
-                            ending_2=options[2],
-                            ending_3=options[3],
-                            label=truth))
-
-    return examples
-
-
-def convert_examples_to_features(examples, tokenizer, max_seq_length, savename):
-    """Loads a data file into a list of `InputBatch`s."""
-
-    # RACE is a multiple choice task. To perform this task using Bert,
-    # we will use the formatting proposed in "Improving Language
-    # Understanding by Generative Pre-Training" and suggested by
-    # @jacobdevlin-google in this issue
-    # https://github.com/google-research/bert/issues/38.
-    #
-    # The input will be like:
-    # [CLS] Article [SEP] Question + Option [SEP]
-    # for each option
-    #
-    # The model will output a single value for each input. To get the
-    # final decision of the model, we will run a softmax over these 4
-    # outputs.
-    features = []
-    max_option_len = 0
-    examples_iter = tqdm(examples, desc="Preprocessing: ", disable=False) if is_main_process() else examples
-    for example_index, example in enumerate(examples_iter):
-        context_tokens = tokenizer.tokenize(example.context_sentence)
-        start_ending_tokens = tokenizer.tokenize(example.start_ending)
-
-        choices_features = []
-        for ending_index, ending in enumerate(example.endings):
-            if False:
-                # We create a copy of the context tokens in order to be
-                # able to shrink it according to ending_tokens
-                context_tokens_choice = context_tokens[:]
-                ending_tokens = start_ending_tokens + tokenizer.tokenize(ending)
-
-                ending_token = tokenizer.tokenize(ending)
-                option_len = len(ending_token)
-                ques_len = len(start_ending_tokens)
-                doc_len = len(context_tokens_choice)
-
-                # Modifies `context_tokens_choice` and `ending_tokens` in
-                # place so that the total length is less than the
-                # specified length.  Account for [CLS], [SEP], [SEP] with
-                # "- 3"
-                _truncate_seq_pair(context_tokens_choice, ending_tokens, max_seq_length - 3)
-
-            # We create a copy of the context tokens in order to be
-            # able to shrink it according to ending_tokens
-            context_tokens_choice = context_tokens[:]  # + start_ending_tokens
-
-            ending_token = tokenizer.tokenize(ending)
-            option_len = len(ending_token)
-            ques_len = len(start_ending_tokens)
-
-            ending_tokens = start_ending_tokens + ending_token
-
-            # Modifies `context_tokens_choice` and `ending_tokens` in
-            # place so that the total length is less than the
-            # specified length.  Account for [CLS], [SEP], [SEP] with
-            # "- 3"
-            # ending_tokens = start_ending_tokens + ending_tokens
-            _truncate_seq_pair(context_tokens_choice, ending_tokens, max_seq_length - 3)
-            doc_len = len(context_tokens_choice)
-            if len(ending_tokens) + len(context_tokens_choice) >= max_seq_length - 3:
-                ques_len = len(ending_tokens) - option_len
-
-            tokens = ["[CLS]"] + context_tokens_choice + ["[SEP]"] + ending_tokens + ["[SEP]"]
-            segment_ids = [0] * (len(context_tokens_choice) + 2) + [1] * (len(ending_tokens) + 1)
-
-            input_ids = tokenizer.convert_tokens_to_ids(tokens)
-            input_mask = [1] * len(input_ids)
-
-            # Zero-pad up to the sequence length.
-            padding = [0] * (max_seq_length - len(input_ids))
-            input_ids += padding
-            input_mask += padding
-            segment_ids += padding
-
-            assert len(input_ids) == max_seq_length
-            assert len(input_mask) == max_seq_length
-            assert len(segment_ids) == max_seq_length
-
-            choices_features.append((tokens, input_ids, input_mask, segment_ids, doc_len, ques_len, option_len))
-
-        label = example.label
-
-        features.append(
-            InputFeatures(
-                example_id=example.race_id,
-                choices_features=choices_features,
-                label=label
-            )
-        )
-
-    with open(savename, "wb") as f:
-        pickle.dump(features, f)
-    return features
-
-
-def _truncate_seq_pair(tokens_a, tokens_b, max_length):
-    """Truncates a sequence pair in place to the maximum length."""
-
-    # This is a simple heuristic which will always truncate the longer sequence
-    # one token at a time. This makes more sense than truncating an equal percent
-    # of tokens from each, since if one sequence is very short then each token
-    # that's truncated likely contains more information than a longer sequence.
-    while True:
-        total_length = len(tokens_a) + len(tokens_b)
-        if total_length <= max_length:
-            break
-        if len(tokens_a) > len(tokens_b):
-            tokens_a.pop()
-        else:
-            tokens_b.pop()
-
-
 def accuracy(out, labels):
-    outputs = np.argmax(out, axis=1)
-    return np.sum(outputs == labels)
-
-
-def select_field(features, field):
-    return [
-        [
-            choice[field]
-            for choice in feature.choices_features
-        ]
-        for feature in features
-    ]
+    return (out.argmax(dim=1) == labels).sum()
 
 
 def warmup_linear(x, warmup=0.002):
@@ -302,27 +73,42 @@ def warmup_linear(x, warmup=0.002):
 class GradientClipper:
     """
     Clips gradient norm of an iterable of parameters.
+    Uses the apex CUDA kernels when they are available, torch ops otherwise (e.g. on the CPU).
     """
 
     def __init__(self, max_grad_norm):
         self.max_norm = max_grad_norm
-        if multi_tensor_applier.available:
+        self.multi_tensor_l2norm = None
+        if not torch.cuda.is_available():
+            return
+        try:
             import amp_C
+            from apex.multi_tensor_apply import multi_tensor_applier
+        except ImportError:
+            return
+        if multi_tensor_applier.available:
+            self.multi_tensor_applier = multi_tensor_applier
             self._overflow_buf = torch.cuda.IntTensor([0])
             self.multi_tensor_l2norm = amp_C.multi_tensor_l2norm
             self.multi_tensor_scale = amp_C.multi_tensor_scale
-        else:
-            raise RuntimeError('Gradient clipping requires cuda extensions')
 
     def step(self, parameters):
         l = [p.grad for p in parameters if p.grad is not None]
-        total_norm, _ = multi_tensor_applier(self.multi_tensor_l2norm, self._overflow_buf, [l], False)
+        fused = self.multi_tensor_l2norm is not None and len(l) > 0 and l[0].is_cuda
+        if fused:
+            total_norm, _ = self.multi_tensor_applier(self.multi_tensor_l2norm, self._overflow_buf, [l], False)
+        else:
+            total_norm = torch.norm(torch.stack([torch.norm(g.detach().float(), 2.0) for g in l]), 2.0)
         total_norm = total_norm.item()
         if (total_norm == float('inf')):
             return
         clip_coef = self.max_norm / (total_norm + 1e-6)
         if clip_coef < 1:
-            multi_tensor_applier(self.multi_tensor_scale, self._overflow_buf, [l, l], clip_coef)
+            if fused:
+                self.multi_tensor_applier(self.multi_tensor_scale, self._overflow_buf, [l, l], clip_coef)
+            else:
+                for g in l:
+                    g.mul_(clip_coef)
 
 
 def main():
@@ -411,20 +197,90 @@ def main():
                         help="Loss scaling to improve fp16 numeric stability. Only used when fp16 set to True.\n"
                              "0 (default value): dynamic loss scaling.\n"
                              "Positive power of 2: static loss scaling value.\n")
+    parser.add_argument('--preprocess_workers',
+                        type=int,
+                        default=1,
+                        help="Number of processes used to convert examples to features (1 converts serially).")
+    parser.add_argument('--feature_cache_dir',
+                        type=str,
+                        default="feature_cache",
+                        help="Directory of the content-addressed feature cache, shared by all the runners.")
+    parser.add_argument('--eval_subset_size',
+                        type=int,
+                        default=300,
+                        help="Dev examples used by the evaluation every 500 steps, drawn once with --seed "
+                             "(0 uses the whole dev set).")
+    parser.add_argument('--num_workers',
+                        type=int,
+                        default=cpu_count(),
+                        help="Number of DataLoader worker processes for the training data. They are kept "
+                             "alive across epochs and pinned to the cores of this process after the first.")
+    parser.add_argument('--prefetch_batches',
+                        type=int,
+                        default=2,
+                        help="Batches fetched and copied to the device ahead of the training step by a "
+                             "background thread (0 fetches them in the training loop).")
+    parser.add_argument('--bf16',
+                        default=False,
+                        action='store_true',
+                        help="Run the forward pass in bfloat16 with torch autocast when training on the CPU "
+                             "(CUDA keeps using apex amp).")
+    parser.add_argument('--cpu_threads',
+                        type=int,
+                        default=0,
+                        help="Intra-op threads of each process on the CPU (0 uses all the cores it may run "
+                             "on, e.g. as bound by launch.py).")
+    parser.add_argument('--cpu_interop_threads',
+                        type=int,
+                        default=1,
+                        help="Inter-op threads of each process on the CPU.")
+    parser.add_argument('--activation_checkpoint_every',
+                        type=int,
+                        default=0,
+                        help="Recompute the activations of every k-th encoder layer in backward instead of "
+                             "storing them, so a larger batch fits for extra compute (1 recomputes all "
+                             "layers, 0 stores all). See benchmarks/bench_activation_checkpointing.py.")
+    parser.add_argument('--checkpoint_steps',
+                        type=int,
+                        default=0,
+                        help="Save a resumable checkpoint to output_dir every N optimizer steps (default 0: none). "
+                             "It is written by a background thread while training goes on.")
+    parser.add_argument('--keep_checkpoints',
+                        type=int,
+                        default=2,
+                        help="Number of newest checkpoints to keep.")
+    parser.add_argument('--resume',
+                        default=False,
+                        action='store_true',
+                        help="Continue from the latest checkpoint in output_dir at the step it was saved, "
+                             "with the same number of processes. output_dir has to be shared by all nodes.")
+    parser.add_argument('--metrics_interval',
+                        type=int,
+                        default=50,
+                        help="Steps between copies of the training loss to the host; loss.txt and "
+                             "TensorBoard are written from a background thread.")
+    parser.add_argument('--length_bucketing',
+                        default=False,
+                        action='store_true',
+                        help="Batch examples of similar length together and pad every batch only to its "
+                             "longest example instead of max_seq_length.")
 
     args = parser.parse_args()
 
-    if args.local_rank == -1 or args.no_cuda:
-        device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
-        n_gpu = torch.cuda.device_count()
-    else:
-        torch.cuda.set_device(args.local_rank)
-        device = torch.device("cuda", args.local_rank)
-        n_gpu = 1
-        # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
-        torch.distributed.init_process_group(backend='nccl', init_method='env://')
+    # NCCL between GPU processes, gloo between CPU processes
+    device, n_gpu = init_distributed(args.local_rank, args.no_cuda)
+    if device.type == 'cpu':
+        tune_cpu_threads(args.cpu_threads, args.cpu_interop_threads)
+    # apex amp on CUDA; on the CPU fp32, or bf16 with torch autocast
+    use_amp = not OLD_MODE and device.type == 'cuda'
+    if use_amp:
+        try:
+            from apex import amp
+        except ImportError:
+            raise ImportError("Training on CUDA needs apex, install it from https://www.github.com/nvidia/apex.")
+    use_bf16 = args.bf16 and device.type == 'cpu'
     if is_main_process():
-        logger.info("device: {} ({}), n_gpu: {}, distributed training: {}, 16-bits training: {}".format(device, torch.cuda.get_device_name(0), n_gpu, bool(args.local_rank != -1), args.fp16))
+        logger.info("device: {} ({}), n_gpu: {}, distributed training: {}, 16-bits training: {}".format(device, device_name(device), n_gpu, bool(args.local_rank != -1), use_amp or use_bf16))
 
     if args.gradient_accumulation_steps < 1:
         raise ValueError("Invalid gradient_accumulation_steps parameter: {}, should be >= 1".format(
@@ -443,18 +299,25 @@ def main():
 
     os.makedirs(args.output_dir, exist_ok=True)
 
+    from transformers import AlbertTokenizer
     tokenizer = AlbertTokenizer.from_pretrained("albert-xxlarge-v2")
 
-    train_examples = None
+    train_arrays = None
     num_train_steps = None
     if args.do_train:
         train_dir = os.path.join(args.data_dir, 'train')
-        train_examples = read_race_examples([train_dir+'/high', train_dir+'/middle'])
-        num_train_steps = int(len(train_examples) / args.train_batch_size / args.gradient_accumulation_steps * args.num_train_epochs)
+        train_files = list_race_files([train_dir+'/high', train_dir+'/middle'])
+        train_arrays, _ = load_or_convert_features(train_files, tokenizer, args.max_seq_length,
+                                                   args.feature_cache_dir, name="train",
+                                                   num_workers=args.preprocess_workers,
+                                                   all_ranks=True)
+        num_train_examples = len(train_arrays['label'])
+        num_train_steps = int(num_train_examples / args.train_batch_size / args.gradient_accumulation_steps * args.num_train_epochs)
 
     # Prepare model
     if NEW_MODEL:
         logger.info("Load new model...")
+        from pytorch_pretrained_bert.modeling import BertForMultipleChoiceWithMatch
         model = BertForMultipleChoiceWithMatch.from_pretrained(args.bert_model,
                                                                cache_dir=PYTORCH_PRETRAINED_BERT_CACHE / 'distributed_{}'.format(args.local_rank),
                                                                num_choices=4)
@@ -463,8 +326,11 @@ def main():
         # model = BertForMultipleChoice.from_pretrained(args.bert_model,
         #                                               cache_dir=PYTORCH_PRETRAINED_BERT_CACHE / 'distributed_{}'.format(args.local_rank),
         #                                               num_choices=4)
+        from transformers import AlbertForMultipleChoice
         model = AlbertForMultipleChoice.from_pretrained("albert-xxlarge-v2")
     model.to(device)
+    if args.activation_checkpoint_every > 0:
+        set_activation_checkpointing(model, args.activation_checkpoint_every)
 
     if OLD_MODE:
         # Prepare optimizer
@@ -491,94 +357,150 @@ def main():
             {'params': [p for n, p in model.named_parameters() if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
         ]
         if USE_ADAM:
+            from transformers import AdamW
             optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate)
         else:
             logger.info("Loading RAdam...")
+            from pytorch_pretrained_bert.optimization import RAdam
             optimizer = RAdam(optimizer_grouped_parameters, lr=args.learning_rate)
 
     global_step = 0
     train_start = time.time()
-    writer = SummaryWriter(os.path.join(args.output_dir, "ascxx"))
+    writer = None
+    if args.do_train:
+        from tensorboardX import SummaryWriter
+        writer = SummaryWriter(os.path.join(args.output_dir, "ascxx"))
+    recorder = MetricsRecorder(writer, interval=args.metrics_interval)
     if args.do_train:
-        train_features = 0
-        if os.path.exists("data.bin"):
-            with open("data.bin", "rb") as f:
-                train_features = pickle.load(f)
-        else:
-            train_features = convert_examples_to_features(train_examples, tokenizer, args.max_seq_length, "data.bin")
         if SIMULATE:
             logger.info("simulating...")
-            train_features = random.sample(train_features, 25000)
+            train_arrays = subset_feature_arrays(train_arrays, random.sample(range(len(train_arrays['label'])), 25000))
 
         if is_main_process():
             logger.info("***** Running training *****")
-            logger.info("  Num examples = %d", len(train_examples))
+            logger.info("  Num examples = %d", num_train_examples)
             logger.info("  Batch size = %d", args.train_batch_size)
             logger.info("  Num steps = %d", num_train_steps)
-        all_input_ids = torch.tensor(select_field(train_features, 'input_ids'), dtype=torch.long)
-        all_input_mask = torch.tensor(select_field(train_features, 'input_mask'), dtype=torch.long)
-        all_segment_ids = torch.tensor(select_field(train_features, 'segment_ids'), dtype=torch.long)
-        all_doc_len = torch.tensor(select_field(train_features, 'doc_len'), dtype=torch.long)
-        all_ques_len = torch.tensor(select_field(train_features, 'ques_len'), dtype=torch.long)
-        all_option_len = torch.tensor(select_field(train_features, 'option_len'), dtype=torch.long)
-        all_label = torch.tensor([f.label for f in train_features], dtype=torch.long)
-        train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label, all_doc_len, all_ques_len, all_option_len)
-
+        train_data = FeatureBatchDataset(train_arrays, transform=trim_padding if args.length_bucketing else None)
+
+        # batches are drawn with their own generator, reseeded every epoch, so they repeat
+        # exactly on --resume and do not consume the global RNG
+        train_generator = torch.Generator()
+        train_generator.manual_seed(args.seed)
+        # the DataLoader draws the worker seeds from a generator of its own: with persistent
+        # workers it only draws on the first epoch it runs, which would shift the shuffle on --resume
+        worker_generator = torch.Generator()
+        worker_generator.manual_seed(args.seed)
         train_sampler = 0
         if args.local_rank != -1:
-            train_sampler = DistributedSampler(train_data)
+            train_sampler = DistributedSampler(train_data, seed=args.seed)
+        else:
+            train_sampler = RandomSampler(train_data, generator=train_generator)
+        if args.length_bucketing:
+            train_batch_sampler = LengthBucketBatchSampler(train_sampler, example_lengths(train_arrays),
+                                                           args.train_batch_size, seed=args.seed)
+            if is_main_process():
+                stats = padding_stats(train_arrays, train_batch_sampler.batches(), args.max_seq_length)
+                logger.info("  Padding = %.1f%% -> %.1f%% with length bucketing, estimated speedup %.2fx",
+                            100 * stats['padding_fixed'], 100 * stats['padding_bucketed'], stats['speedup'])
         else:
-            train_sampler = RandomSampler(train_data)
+            train_batch_sampler = BatchSampler(train_sampler, args.train_batch_size, drop_last=False)
+        train_batch_sampler = ResumableBatchSampler(train_batch_sampler, seed=args.seed)
         train_dataloader = DataLoader(train_data,
-                                      sampler=train_sampler,
-                                      batch_size=args.train_batch_size,
-                                      num_workers=cpu_count(),
-                                      prefetch_factor=2,
-                                      pin_memory=True)
+                                      sampler=train_batch_sampler,
+                                      batch_size=None,
+                                      num_workers=args.num_workers,
+                                      persistent_workers=args.num_workers > 0,
+                                      worker_init_fn=set_worker_affinity,
+                                      generator=worker_generator,
+                                      pin_memory=device.type == 'cuda')
 
         model.train()
-        if not OLD_MODE:
+        if use_amp:
             model, optimizer = amp.initialize(model, optimizer, opt_level="O1")
+        if not OLD_MODE:
+            from transformers import get_linear_schedule_with_warmup
             scheduler = get_linear_schedule_with_warmup(optimizer, int(num_train_steps * args.warmup_proportion), num_train_steps)
         if OLD_MODE:
             gradClipper = GradientClipper(max_grad_norm=1.0)
 
+        start_epoch, start_batch, resume_rng = 0, 0, None
+        if args.resume:
+            checkpoint = find_latest_checkpoint(args.output_dir, get_world_size())
+            if checkpoint is None:
+                logger.info("No checkpoint in %s, training from scratch", args.output_dir)
+            else:
+                logger.info("Resuming from %s", checkpoint)
+                state, resume_rng = load_checkpoint(checkpoint, get_rank())
+                model.load_state_dict(state['model'])
+                optimizer.load_state_dict(state['optimizer'])
+                if not OLD_MODE:
+                    scheduler.load_state_dict(state['scheduler'])
+                if use_amp:
+                    amp.load_state_dict(state['amp'])
+                global_step, start_epoch, start_batch = state['global_step'], state['epoch'], state['batches']
+                del state
+        checkpointer = AsyncCheckpointer(args.output_dir, get_rank(), keep=args.keep_checkpoints,
+                                        world_size=get_world_size())
+
         if args.local_rank != -1:
             logger.info("Initializing DistributedDataParallel")
+            # CPU processes (gloo) pass no device ids
             model = DistributedDataParallel(model,
-                                            device_ids=[args.local_rank],
-                                            output_device=args.local_rank,
+                                            device_ids=[args.local_rank] if device.type == 'cuda' else None,
+                                            output_device=args.local_rank if device.type == 'cuda' else None,
                                             find_unused_parameters=True)
             logger.info("DistributedDataParallel initialized")
 
-        for ep in range(int(args.num_train_epochs)):
+        if args.local_rank == 0 or args.local_rank == -1:
+            # the dev batches of the periodic evaluation are built once
+            dev_dir = os.path.join(args.data_dir, 'dev')
+            dev_set = [dev_dir+'/high', dev_dir+'/middle']
+            eval_arrays, _ = load_or_convert_features(list_race_files(dev_set),
+                                                      tokenizer,
+                                                      args.max_seq_length,
+                                                      args.feature_cache_dir,
+                                                      name="eval",
+                                                      num_workers=args.preprocess_workers)
+            eval_batches = CachedEvalBatches(eval_arrays, args.eval_batch_size, args.eval_subset_size, seed=args.seed,
+                                             trim=args.length_bucketing, device=device)
+            del eval_arrays
+
+        train_batches = BackgroundPrefetcher(train_dataloader, device, depth=args.prefetch_batches)
+        if resume_rng is not None:
+            set_rng_state(resume_rng)
+        for ep in range(start_epoch, int(args.num_train_epochs)):
+            first_batch = start_batch if ep == start_epoch else 0
+            train_batch_sampler.set_epoch(ep, first_batch)
             tr_loss = 0
-            train_iter = tqdm(train_dataloader, disable=False) if is_main_process() else train_dataloader
+            train_iter = tqdm(train_batches, disable=False) if is_main_process() else train_batches
             if is_main_process():
                 train_iter.set_description("Trianing Epoch: {}/{}".format(ep+1, int(args.num_train_epochs)))
-            for step, batch in enumerate(train_iter):
-                batch = tuple(t.to(device) for t in batch)
-                input_ids, input_mask, segment_ids, label_ids, doc_lens, ques_lens, option_lens = batch
-                if NEW_MODEL:
-                    loss = model(input_ids, segment_ids, input_mask, doc_lens, ques_lens, option_lens, label_ids)
-                else:
-                    outputs = model(input_ids=input_ids, token_type_ids=segment_ids, attention_mask=input_mask, labels=label_ids)
-                    loss = outputs.loss
+            epoch_start, nb_tr_examples = time.time(), 0
+            for step, batch in enumerate(train_iter, first_batch):
+                input_ids, input_mask, segment_ids, label_ids, doc_lens, ques_lens, option_lens = batch_to_inputs(batch, device)
+                with torch.autocast('cpu', dtype=torch.bfloat16, enabled=use_bf16):
+                    if NEW_MODEL:
+                        loss = model(input_ids, segment_ids, input_mask, doc_lens, ques_lens, option_lens, label_ids)
+                    else:
+                        outputs = model(input_ids=input_ids, token_type_ids=segment_ids, attention_mask=input_mask, labels=label_ids)
+                        loss = outputs.loss
                 if n_gpu > 1:
                     loss = loss.mean()  # mean() to average on multi-gpu.
                 if args.gradient_accumulation_steps > 1:
                     loss = loss / args.gradient_accumulation_steps
-                tr_loss += loss.item()
-                with open("loss.txt", "a", encoding="utf-8") as f:
-                    f.write(f"{loss.item()}\n")
+                tr_loss += loss.detach()
+                nb_tr_examples += label_ids.size(0)
 
-                if not OLD_MODE:
+                if use_amp:
                     with amp.scale_loss(loss, optimizer) as scaled_loss:
                         scaled_loss.backward()
+                elif not OLD_MODE:
+                    loss.backward()
 
                 if OLD_MODE:
                     loss.backward()
-                    gradClipper.step(amp.master_params(optimizer))
+                    gradClipper.step(amp.master_params(optimizer) if use_amp else optimizer_params(optimizer))
 
                 if (step + 1) % args.gradient_accumulation_steps == 0:
                     if OLD_MODE:
@@ -592,63 +514,51 @@ def main():
                     optimizer.zero_grad()
                     global_step += 1
 
+                    if args.checkpoint_steps > 0 and global_step % args.checkpoint_steps == 0:
+                        state = None
+                        if is_main_process():
+                            model_to_save = model.module if hasattr(model, 'module') else model
+                            state = {'model': model_to_save.state_dict(),
+                                     'optimizer': optimizer.state_dict(),
+                                     'global_step': global_step,
+                                     'epoch': ep,
+                                     'batches': step + 1}
+                            if not OLD_MODE:
+                                state['scheduler'] = scheduler.state_dict()
+                            if use_amp:
+                                state['amp'] = amp.state_dict()
+                        checkpointer.save(global_step, state)
+
                     if global_step % 500 == 0 and (args.local_rank == 0 or args.local_rank == -1):
-                        dev_dir = os.path.join(args.data_dir, 'dev')
-                        dev_set = [dev_dir+'/high', dev_dir+'/middle']
-
-                        eval_examples = read_race_examples(dev_set)
-                        eval_features = 0
-                        if os.path.exists("eval.bin"):
-                            with open("eval.bin", "rb") as f:
-                                eval_features = pickle.load(f)
-                        else:
-                            eval_features = convert_examples_to_features(eval_examples,
-                                                                         tokenizer,
-                                                                         args.max_seq_length,
-                                                                         "eval.bin")
-                        eval_features = random.sample(eval_features, 300)
                         logger.info("***** Running evaluation: Dev *****")
-                        logger.info("  Num examples = %d", len(eval_examples))
+                        logger.info("  Num examples = %d of %d", eval_batches.num_examples, eval_batches.total_examples)
                         logger.info("  Batch size = %d", args.eval_batch_size)
-                        all_input_ids = torch.tensor(select_field(eval_features, 'input_ids'), dtype=torch.long)
-                        all_input_mask = torch.tensor(select_field(eval_features, 'input_mask'), dtype=torch.long)
-                        all_segment_ids = torch.tensor(select_field(eval_features, 'segment_ids'), dtype=torch.long)
-                        all_doc_len = torch.tensor(select_field(eval_features, 'doc_len'), dtype=torch.long)
-                        all_ques_len = torch.tensor(select_field(eval_features, 'ques_len'), dtype=torch.long)
-                        all_option_len = torch.tensor(select_field(eval_features, 'option_len'), dtype=torch.long)
-                        all_label = torch.tensor([f.label for f in eval_features], dtype=torch.long)
-                        eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label, all_doc_len, all_ques_len, all_option_len)
-                        # Run prediction for full data
-                        eval_sampler = SequentialSampler(eval_data)
-                        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
 
                         model.eval()
-                        eval_loss, eval_accuracy = 0, 0
+                        eval_loss = torch.zeros((), device=device)
+                        eval_accuracy = torch.zeros((), dtype=torch.long, device=device)
                         nb_eval_steps, nb_eval_examples = 0, 0
-                        for step, batch in enumerate(eval_dataloader):
-                            batch = tuple(t.to(device) for t in batch)
-                            input_ids, input_mask, segment_ids, label_ids, doc_lens, ques_lens, option_lens = batch
+                        for eval_step, eval_batch in enumerate(eval_batches):
+                            input_ids, input_mask, segment_ids, label_ids, doc_lens, ques_lens, option_lens = batch_to_inputs(eval_batch, device)
 
-                            with torch.no_grad():
+                            with torch.no_grad(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=use_bf16):
                                 if NEW_MODEL:
+                                    # BertForMultipleChoiceWithMatch is not in this tree (NEW_MODEL is fixed to False),
+                                    # so it has no `return_logits` and this branch keeps its two passes.
                                     tmp_eval_loss = model(input_ids, segment_ids, input_mask, doc_lens, ques_lens, option_lens, label_ids)
                                     logits = model(input_ids, segment_ids, input_mask, doc_lens, ques_lens, option_lens)
                                 else:
                                     outputs = model(input_ids=input_ids, token_type_ids=segment_ids, attention_mask=input_mask, labels=label_ids)
-                                    tmp_eval_loss = outputs.loss
-                                    outputs = model(input_ids=input_ids, token_type_ids=segment_ids, attention_mask=input_mask)
-                                    logits = outputs.logits
-
-                            logits = logits.detach().cpu().numpy()
-                            label_ids = label_ids.to('cpu').numpy()
-                            tmp_eval_accuracy = accuracy(logits, label_ids)
+                                    tmp_eval_loss, logits = outputs.loss, outputs.logits
 
-                            eval_loss += tmp_eval_loss.mean().item()
-                            eval_accuracy += tmp_eval_accuracy
+                            eval_loss += tmp_eval_loss.mean()
+                            eval_accuracy += accuracy(logits, label_ids)
 
                             nb_eval_examples += input_ids.size(0)
                             nb_eval_steps += 1
 
+                        # a single synchronization for the whole evaluation
+                        eval_loss, eval_accuracy = torch.stack([eval_loss.double(), eval_accuracy.double()]).tolist()
                         eval_loss = eval_loss / nb_eval_steps
                         eval_accuracy = eval_accuracy / nb_eval_examples
 
@@ -662,13 +572,20 @@ def main():
                             for key in sorted(result.keys()):
                                 logger.info("  %s = %s", key, str(result[key]))
                                 writer_eval.write("%s = %s\n" % (key, str(result[key])))
+                        model.train()
 
-                if is_main_process():
-                    train_iter.set_postfix(loss=loss.item())
-                writer.add_scalar('loss', loss.item(), global_step=global_step)
+                recorder.record(loss, global_step)
+                if is_main_process() and recorder.last_loss is not None:
+                    train_iter.set_postfix(loss=recorder.last_loss)
+            if is_main_process():
+                logger.info("  Data wait = %.2f ms/step", 1000 * train_batches.wait_time / max(1, train_batches.steps))
+                logger.info("  Throughput = %.1f samples/s", nb_tr_examples * get_world_size() / (time.time() - epoch_start))
+        checkpointer.wait()
 
     finish_time = time.time()
-    writer.close()
+    recorder.close()
+    if writer is not None:
+        writer.close()
     # Save a trained model
     if is_main_process():
         logger.info("ete_time: {}, training_time: {}".format(finish_time-ete_start, finish_time-train_start))
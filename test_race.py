@@ -19,24 +19,23 @@ import logging
 import os
 import argparse
 import random
-from tqdm import tqdm, trange
-import csv
-import glob
+from tqdm import tqdm
 import json
-import apex
+import time
 import shutil
 
 import numpy as np
 import torch
-from torch.utils.data import TensorDataset, DataLoader, RandomSampler, SequentialSampler, Dataset
+from torch.utils.data import DataLoader, SequentialSampler, BatchSampler
 from torch.utils.data.distributed import DistributedSampler
 
 from pytorch_pretrained_bert.tokenization import BertTokenizer
 from pytorch_pretrained_bert.optimization import BertAdam
 from pytorch_pretrained_bert.file_utils import PYTORCH_PRETRAINED_BERT_CACHE
-from pytorch_pretrained_bert.utils import is_main_process
+from pytorch_pretrained_bert.utils import is_main_process, init_distributed, tune_cpu_threads, device_name
+from pytorch_pretrained_bert.race_utils import list_race_files, read_race_source, load_or_convert_features
+from pytorch_pretrained_bert.race_utils import subset_feature_arrays, FeatureBatchDataset, batch_to_inputs
 
-from transformers import BertForMultipleChoice
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt='%m/%d/%Y %H:%M:%S',
@@ -95,160 +94,38 @@ class RaceExample(object):
         return ", ".join(l)
 
 
-class InputFeatures(object):
-    def __init__(self,
-                 example_id,
-                 choices_features,
-                 label
-
-                 ):
-        self.example_id = example_id
-        self.choices_features = [
-            {
-                'input_ids': input_ids,
-                'input_mask': input_mask,
-                'segment_ids': segment_ids
-            }
-            for _, input_ids, input_mask, segment_ids in choices_features
-        ]
-        self.label = label
-
 # paths is a list containing all paths
 
 
 def read_race_examples(filenames):
     examples = []
     for filename in filenames:
-        with open(filename, 'r', encoding='utf-8') as fpr:
-            data_raw = json.load(fpr)
-            article = data_raw['article']
-            # for each qn
-            for i in range(len(data_raw['answers'])):
-                truth = ord(data_raw['answers'][i]) - ord('A')
-                question = data_raw['questions'][i]
-                options = data_raw['options'][i]
-                examples.append(
-                    RaceExample(
-                        race_id=os.path.basename(filename)+'-'+str(i),
-                        context_sentence=article,
-                        start_ending=question,
-
-                        ending_0=options[0],
-                        ending_1=options[1],
-                        ending_2=options[2],
-                        ending_3=options[3],
-                        label=truth))
+        data_raw = json.loads(read_race_source(filename).decode('utf-8'))
+        article = data_raw['article']
+        # for each qn
+        for i in range(len(data_raw['answers'])):
+            truth = ord(data_raw['answers'][i]) - ord('A')
+            question = data_raw['questions'][i]
+            options = data_raw['options'][i]
+            examples.append(
+                RaceExample(
+                    race_id=os.path.basename(filename)+'-'+str(i),
+                    context_sentence=article,
+                    start_ending=question,
+
+                    ending_0=options[0],
+                    ending_1=options[1],
+                    ending_2=options[2],
+                    ending_3=options[3],
+                    label=truth))
 
     return examples
 
 
-def convert_examples_to_features(examples, tokenizer, max_seq_length,
-                                 is_training):
-    """Loads a data file into a list of `InputBatch`s."""
-
-    # RACE is a multiple choice task. To perform this task using Bert,
-    # we will use the formatting proposed in "Improving Language
-    # Understanding by Generative Pre-Training" and suggested by
-    # @jacobdevlin-google in this issue
-    # https://github.com/google-research/bert/issues/38.
-    #
-    # The input will be like:
-    # [CLS] Article [SEP] Question + Option [SEP]
-    # for each option
-    #
-    # The model will output a single value for each input. To get the
-    # final decision of the model, we will run a softmax over these 4
-    # outputs.
-    features = []
-    max_option_len = 0
-    for example_index, example in enumerate(examples):
-        context_tokens = tokenizer.tokenize(example.context_sentence)
-        start_ending_tokens = tokenizer.tokenize(example.start_ending)
-
-        choices_features = []
-        for ending_index, ending in enumerate(example.endings):
-            # We create a copy of the context tokens in order to be
-            # able to shrink it according to ending_tokens
-            context_tokens_choice = context_tokens[:]
-            ending_tokens = start_ending_tokens + tokenizer.tokenize(ending)
-            # Modifies `context_tokens_choice` and `ending_tokens` in
-            # place so that the total length is less than the
-            # specified length.  Account for [CLS], [SEP], [SEP] with
-            # "- 3"
-
-            _truncate_seq_pair(context_tokens_choice, ending_tokens, max_seq_length - 3)
-
-            tokens = ["[CLS]"] + context_tokens_choice + ["[SEP]"] + ending_tokens + ["[SEP]"]
-            segment_ids = [0] * (len(context_tokens_choice) + 2) + [1] * (len(ending_tokens) + 1)
-
-            input_ids = tokenizer.convert_tokens_to_ids(tokens)
-            input_mask = [1] * len(input_ids)
-
-            # Zero-pad up to the sequence length.
-            padding = [0] * (max_seq_length - len(input_ids))
-            input_ids += padding
-            input_mask += padding
-            segment_ids += padding
-
-            assert len(input_ids) == max_seq_length
-            assert len(input_mask) == max_seq_length
-            assert len(segment_ids) == max_seq_length
-
-            choices_features.append((tokens, input_ids, input_mask, segment_ids))
-
-        label = example.label
-        # display some example
-        # if example_index < 1:
-        #     logger.info("*** Example ***")
-        #     logger.info(f"race_id: {example.race_id}")
-        #     for choice_idx, (tokens, input_ids, input_mask, segment_ids) in enumerate(choices_features):
-        #         logger.info(f"choice: {choice_idx}")
-        #         logger.info(f"tokens: {' '.join(tokens)}")
-        #         logger.info(f"input_ids: {' '.join(map(str, input_ids))}")
-        #         logger.info(f"input_mask: {' '.join(map(str, input_mask))}")
-        #         logger.info(f"segment_ids: {' '.join(map(str, segment_ids))}")
-        #     if is_training:
-        #         logger.info(f"label: {label}")
-        features.append(
-            InputFeatures(
-                example_id=example.race_id,
-                choices_features=choices_features,
-                label=label
-            )
-        )
-
-    return features
-
-
-def _truncate_seq_pair(tokens_a, tokens_b, max_length):
-    """Truncates a sequence pair in place to the maximum length."""
-
-    # Note: only truncate sequence A
-    while True:
-        total_length = len(tokens_a) + len(tokens_b)
-        if total_length <= max_length:
-            break
-        tokens_a.pop()
-        # if len(tokens_a) > len(tokens_b):
-        #     tokens_a.pop()
-        # else:
-        #     tokens_b.pop()
-
-
 def accuracy(out, labels):
     return np.sum(out == labels)
 
 
-def select_field(features, field):
-    return [
-        [
-            choice[field]
-            for choice in feature.choices_features
-        ]
-        for feature in features
-    ]
-
-
 def warmup_linear(x, warmup=0.002):
     if x < warmup:
         return x/warmup
@@ -303,6 +180,16 @@ def main():
                         help="local_rank for distributed training on gpus")
     parser.add_argument("--eval_batch_size", type=int, default=8)
     parser.add_argument("--method", type=str, default="count")
+    parser.add_argument("--preprocess_workers", type=int, default=1,
+                        help="Number of processes used to convert examples to features (1 converts serially).")
+    parser.add_argument("--feature_cache_dir", type=str, default="feature_cache",
+                        help="Directory of the content-addressed feature cache, shared by all the runners.")
+    parser.add_argument("--bf16", default=False, action='store_true',
+                        help="Run the models in bfloat16 with torch autocast on the CPU.")
+    parser.add_argument("--cpu_threads", type=int, default=0,
+                        help="Intra-op threads on the CPU (0 uses all the cores this process may run on).")
+    parser.add_argument("--cpu_interop_threads", type=int, default=1,
+                        help="Inter-op threads on the CPU.")
     parser.add_argument("model_paths", nargs=argparse.REMAINDER)
 
     args = parser.parse_args()
@@ -310,20 +197,17 @@ def main():
     for model_path in args.model_paths:
         shutil.copy(os.path.join(model_path, "bert_config.json"), os.path.join(model_path, "config.json"))
 
-    if args.local_rank == -1 or args.no_cuda:
-        device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
-        n_gpu = torch.cuda.device_count()
-    else:
-        torch.cuda.set_device(0)
-        device = torch.device("cuda", args.local_rank)
-        n_gpu = 1
-        # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
-        torch.distributed.init_process_group(backend='nccl')
-    logger.info("device: {} ({}) n_gpu: {}".format(device, torch.cuda.get_device_name(0), n_gpu))
+    # NCCL between GPU processes, gloo between CPU processes
+    device, n_gpu = init_distributed(args.local_rank, args.no_cuda)
+    if device.type == 'cpu':
+        tune_cpu_threads(args.cpu_threads, args.cpu_interop_threads)
+    use_bf16 = args.bf16 and device.type == 'cpu'
+    logger.info("device: {} ({}) n_gpu: {}".format(device, device_name(device), n_gpu))
 
     tokenizer = BertTokenizer.from_pretrained(args.vocab_file, do_lower_case=args.do_lower_case)
 
     # Prepare model
+    from transformers import BertForMultipleChoice
     models = []
     for model_path in args.model_paths:
         logger.info("Loading model {}".format(model_path))
@@ -333,35 +217,42 @@ def main():
         models.append(model)
 
     # test
-    filenames = list(glob.glob(os.path.join(args.data_dir, "test", "high") + "/*.txt")) + list(glob.glob(os.path.join(args.data_dir, "test", "middle") + "/*.txt"))
-    filenames = sorted(filenames)
+    filenames = list_race_files([os.path.join(args.data_dir, "test", "high"), os.path.join(args.data_dir, "test", "middle")],
+                                pattern="*.txt")
+
+    # Convert every test file up front so the tokenization can be spread over
+    # `--preprocess_workers` processes, then evaluate file by file as before.
+    test_arrays, file_offsets = load_or_convert_features(filenames,
+                                                         tokenizer,
+                                                         args.max_seq_length,
+                                                         args.feature_cache_dir,
+                                                         name="test",
+                                                         num_workers=args.preprocess_workers,
+                                                         truncate_article_only=True,
+                                                         read_fn=lambda filename: read_race_examples([filename]),
+                                                         all_ranks=True)
     eval_iter = tqdm(filenames, disable=False)
     eval_answers = {}
     eval_accuracy = 0
     nb_eval_examples = 0
+    eval_start, nb_examples = time.time(), 0
     for fid, filename in enumerate(eval_iter):
-        file_path = os.path.join(filename)
-        eval_examples = read_race_examples([file_path])
-        eval_features = convert_examples_to_features(eval_examples, tokenizer, args.max_seq_length, True)
-        all_input_ids = torch.tensor(select_field(eval_features, 'input_ids'), dtype=torch.long)
-        all_input_mask = torch.tensor(select_field(eval_features, 'input_mask'), dtype=torch.long)
-        all_segment_ids = torch.tensor(select_field(eval_features, 'segment_ids'), dtype=torch.long)
-        all_label = torch.tensor([f.label for f in eval_features], dtype=torch.long)
-        eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label)
+        eval_arrays = subset_feature_arrays(test_arrays, slice(file_offsets[fid], file_offsets[fid + 1]))
+        eval_data = FeatureBatchDataset(eval_arrays)
         # Run prediction for full data
         eval_sampler = SequentialSampler(eval_data)
-        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
+        eval_dataloader = DataLoader(eval_data, sampler=BatchSampler(eval_sampler, args.eval_batch_size, drop_last=False),
+                                     batch_size=None)
         eval_answer = []
         for step, batch in enumerate(eval_dataloader):
-            batch = tuple(t.to(device) for t in batch)
-            input_ids, input_mask, segment_ids, label_ids = batch
+            input_ids, input_mask, segment_ids, label_ids, _, _, _ = batch_to_inputs(batch, device)
 
             all_logits = []  # ModelCount x Batch x Options
             votes = []
-            with torch.no_grad():
+            with torch.no_grad(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=use_bf16):
                 for model in models:
                     logits = model(input_ids=input_ids, token_type_ids=segment_ids, attention_mask=input_mask).logits
-                    logits = logits.detach().cpu().numpy()
+                    logits = logits.detach().float().cpu().numpy()
                     all_logits.append(logits)
                     votes.append(np.argmax(logits, axis=1))
 
@@ -394,6 +285,7 @@ def main():
                                     index = one_model_vote
                     max_indices.append(index)
             max_indices = np.array(max_indices)
+            nb_examples += input_ids.size(0)
             eval_answer.extend([chr(op) for op in max_indices+ord("A")])
             if args.has_ans:
                 label_ids = label_ids.to('cpu').numpy()
@@ -404,6 +296,7 @@ def main():
                 nb_eval_examples += input_ids.size(0)
 
         eval_answers[os.path.basename(filename).replace(".txt", "")] = eval_answer
+    logger.info("throughput: {:.1f} samples/s".format(nb_examples / (time.time() - eval_start)))
     final_eval_accuracy = eval_accuracy / nb_eval_examples
     logger.info("eval accuracy: {}".format(final_eval_accuracy))
     result = json.dumps(eval_answers)